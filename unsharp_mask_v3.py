@@ -7,6 +7,26 @@ This script provides a GUI interface for the unsharp mask command.
 
 import sys
 import time
+import argparse
+
+# 起動時間（表示までの時間・操作可能になるまでの時間）の計測基準
+SCRIPT_START_TIME = time.perf_counter()
+
+import os
+import glob
+import queue
+import shutil
+import tempfile
+import tracemalloc
+import zlib
+import json
+import platform
+import threading
+import contextlib
+import importlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
 import sirilpy as s
 from sirilpy import SirilConnectionError, SirilError
 try:
@@ -16,72 +36,2765 @@ except ImportError:
     ProcessingThreadBusyError = SirilError
     ImageDialogOpenError = SirilError
 
-s.ensure_installed("PyQt6")
-s.ensure_installed("scipy")
 import numpy as np
-from scipy.ndimage import gaussian_filter
+
+
+# ---------------------------------------------------------------------------
+# 設定・キャッシュの保存先
+# ---------------------------------------------------------------------------
+
+def get_config_dir():
+    """スクリプトの設定・キャッシュを保存するディレクトリを返す"""
+    if sys.platform.startswith("win"):
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(base, "siril_unsharp_mask")
+
+
+def load_json_cache(filename):
+    """設定ディレクトリのJSONファイルを読み込む（存在しない・壊れている場合は空の辞書）"""
+    try:
+        with open(os.path.join(get_config_dir(), filename), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json_cache(filename, data):
+    """設定ディレクトリにJSONファイルを書き込む（失敗しても処理は継続する）"""
+    try:
+        os.makedirs(get_config_dir(), exist_ok=True)
+        path = os.path.join(get_config_dir(), filename)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+# ---------------------------------------------------------------------------
+# 依存パッケージの確認（結果は実行環境ごとにキャッシュする）
+# ---------------------------------------------------------------------------
+
+DEPENDENCY_CACHE_FILE = "dependencies.json"
+_verified_modules = set()
+
+
+def ensure_installed_cached(package, module=None):
+    """s.ensure_installed() を呼ぶ。確認済みでモジュールが見つかる場合は省略する"""
+    module = module or package
+    if module in _verified_modules:
+        return
+    cache = load_json_cache(DEPENDENCY_CACHE_FILE)
+    verified = cache.get(sys.executable, {})
+    if package not in verified or importlib.util.find_spec(module) is None:
+        s.ensure_installed(package)
+        verified[package] = time.strftime("%Y-%m-%d %H:%M:%S")
+        cache[sys.executable] = verified
+        save_json_cache(DEPENDENCY_CACHE_FILE, cache)
+    _verified_modules.add(module)
+
+
+def lazy_scipy(submodule):
+    """scipy のサブモジュールを初回使用時に読み込む（起動を速くするため）"""
+    ensure_installed_cached("scipy")
+    return importlib.import_module(f"scipy.{submodule}")
+
+
+def gaussian_filter(data, sigma):
+    """scipy.ndimage.gaussian_filter（scipyは初回使用時に読み込む）"""
+    return lazy_scipy("ndimage").gaussian_filter(data, sigma=sigma)
+
+
+ensure_installed_cached("PyQt6")
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                               QHBoxLayout, QLabel, QSlider, QLineEdit, QPushButton,
-                              QMessageBox)
-from PyQt6.QtCore import Qt, QTimer
+                              QMessageBox, QComboBox, QProgressBar, QDialog, QGridLayout,
+                              QScrollArea, QSpinBox, QToolButton, QCheckBox, QListWidget,
+                              QListWidgetItem, QInputDialog)
+from PyQt6.QtCore import Qt, QTimer, QThread, QSize, pyqtSignal
+from PyQt6.QtGui import QImage, QPixmap, QIcon
+
+
+# ---------------------------------------------------------------------------
+# ブラーバックエンド
+# ---------------------------------------------------------------------------
+
+# scipy.ndimage.gaussian_filter のデフォルト (truncate=4.0) に合わせる
+GAUSSIAN_TRUNCATE = 4.0
+
+
+def gaussian_radius(sigma):
+    """gaussian_filter と同じカーネル半径を返す"""
+    return int(GAUSSIAN_TRUNCATE * float(sigma) + 0.5)
+
+
+def gaussian_kernel1d(sigma):
+    """gaussian_filter と同じ正規化済みの1次元ガウシアンカーネルを返す"""
+    radius = gaussian_radius(sigma)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 / (float(sigma) ** 2) * x * x)
+    return kernel / kernel.sum()
+
+
+def spatial_sigma(data, sigma):
+    """チャンネル軸にはブラーをかけないsigmaの指定を返す"""
+    # Sirilのデータは (channels, height, width) または (height, width)
+    if data.ndim == 3:
+        return (0, sigma, sigma)
+    return sigma
+
+
+BLUR_BACKENDS = {}
+
+
+def register_blur_backend(cls):
+    """ブラーバックエンドをレジストリに登録する（クラスデコレータ）"""
+    BLUR_BACKENDS[cls.name] = cls
+    return cls
+
+
+def available_blur_backends():
+    """現在の環境で利用可能なバックエンド名のリストを返す"""
+    return [name for name, cls in BLUR_BACKENDS.items() if cls.is_available()]
+
+
+class BlurBackend:
+    """ブラーバックエンドの基底クラス
+    
+    blur() は float32 の (channels, height, width) または (height, width) 配列を受け取り、
+    空間方向（最後の2軸）だけにガウシアンブラーをかけた float32 配列を返す。
+    """
+    name = ""
+    label = ""
+    # gaussian_filter と浮動小数点誤差の範囲で一致するか
+    exact = True
+    # 自動キャリブレーションの候補にするか
+    calibratable = True
+    # siril.cmd() を使うため image_lock の外で呼び出す必要があるか
+    needs_command = False
+    # 行方向のタイルに分けて処理しても結果が変わらないか
+    tileable = True
+    
+    def __init__(self, siril=None, native_dtype=np.float32):
+        self.siril = siril
+        self.native_dtype = native_dtype
+    
+    @classmethod
+    def is_available(cls):
+        return True
+    
+    def blur(self, data, sigma):
+        raise NotImplementedError
+
+
+@register_blur_backend
+class ScipyBlurBackend(BlurBackend):
+    """scipy.ndimage.gaussian_filter による空間畳み込み（v3の従来の実装）"""
+    name = "scipy"
+    label = "SciPy (空間)"
+    
+    def blur(self, data, sigma):
+        return gaussian_filter(data, sigma=spatial_sigma(data, sigma))
+
+
+@register_blur_backend
+class ScipyFFTBlurBackend(BlurBackend):
+    """FFT畳み込みによるガウシアンブラー（sigmaが大きいときに有利）"""
+    name = "scipy_fft"
+    label = "SciPy (FFT)"
+    
+    def blur(self, data, sigma):
+        fftconvolve = lazy_scipy("signal").fftconvolve
+        
+        radius = gaussian_radius(sigma)
+        kernel = gaussian_kernel1d(sigma).astype(np.float32)
+        lead = (1,) * (data.ndim - 2)
+        # gaussian_filter の mode="reflect" は numpy の "symmetric" に相当する
+        pad = [(0, 0)] * (data.ndim - 2) + [(radius, radius), (radius, radius)]
+        padded = np.pad(data, pad, mode="symmetric")
+        # 縦方向・横方向の順に1次元カーネルで畳み込む（分離可能フィルタ）
+        out = fftconvolve(padded, kernel.reshape(lead + (-1, 1)), mode="valid", axes=(-2, -1))
+        out = fftconvolve(out, kernel.reshape(lead + (1, -1)), mode="valid", axes=(-2, -1))
+        return out.astype(np.float32, copy=False)
+
+
+@register_blur_backend
+class RecursiveBlurBackend(BlurBackend):
+    """Young & van Vliet の再帰型 (IIR) ガウシアン近似
+    
+    計算量がsigmaに依存しないが、gaussian_filter とは近似誤差の分だけ結果が異なる。
+    """
+    name = "recursive"
+    label = "再帰型ガウシアン (近似)"
+    exact = False
+    calibratable = False
+    # IIRフィルタの影響範囲はカーネル半径で打ち切れないため、タイルの境目に段差が出る
+    tileable = False
+    
+    # これより小さいsigmaでは近似が成り立たないため空間畳み込みを使う
+    MIN_SIGMA = 0.5
+    
+    @staticmethod
+    def coefficients(sigma):
+        """IIRフィルタの係数 (b, a) を返す"""
+        if sigma >= 2.5:
+            q = 0.98711 * sigma - 0.96330
+        else:
+            q = 3.97156 - 4.14554 * np.sqrt(1.0 - 0.26891 * sigma)
+        b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+        b1 = 2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3
+        b2 = -(1.4281 * q ** 2 + 1.26661 * q ** 3)
+        b3 = 0.422205 * q ** 3
+        gain = 1.0 - (b1 + b2 + b3) / b0
+        return np.array([gain]), np.array([1.0, -b1 / b0, -b2 / b0, -b3 / b0])
+    
+    def blur(self, data, sigma):
+        if sigma < self.MIN_SIGMA:
+            return gaussian_filter(data, sigma=spatial_sigma(data, sigma))
+        
+        signal = lazy_scipy("signal")
+        lfilter = signal.lfilter
+        
+        b, a = self.coefficients(sigma)
+        zi = signal.lfilter_zi(b, a)
+        
+        def run(x):
+            # 前方向・逆方向の順に最後の軸へ適用する（端は定常状態で初期化）
+            y, _ = lfilter(b, a, x, axis=-1, zi=zi * x[..., :1])
+            y = y[..., ::-1]
+            y, _ = lfilter(b, a, y, axis=-1, zi=zi * y[..., :1])
+            return y[..., ::-1]
+        
+        out = run(data)
+        out = np.swapaxes(run(np.swapaxes(out, -1, -2)), -1, -2)
+        return np.ascontiguousarray(out, dtype=np.float32)
+
+
+@register_blur_backend
+class SirilBlurBackend(BlurBackend):
+    """Sirilの unsharp コマンド（v1/v2.1の方式）でブラーを計算する
+    
+    Sirilの unsharp は multi=0 のときガウシアンブラーのみを行うことを利用する。
+    Sirilの画像を書き換えるため、自動キャリブレーションの対象外としている。
+    """
+    name = "siril"
+    label = "Siril (unsharpコマンド)"
+    exact = False
+    calibratable = False
+    needs_command = True
+    tileable = False
+    
+    def blur(self, data, sigma):
+        if self.siril is None:
+            raise SirilError("Sirilバックエンドには接続済みのSirilInterfaceが必要です")
+        # 画像の型に合わせてSirilへ渡す（uint16画像の値は整数なので変換で誤差は出ない）
+        pixels = np.ascontiguousarray(data, dtype=self.native_dtype)
+        session = siril_session(self.siril)
+        session.push(pixels, "blur")
+        # cmd()はロック内で実行してはいけない
+        session.command("unsharp", f"{sigma:.2f}", "0")
+        blurred = session.snapshot("blur")
+        return np.asarray(blurred, dtype=np.float32)
+
+
+@register_blur_backend
+class OpenCVBlurBackend(BlurBackend):
+    """OpenCV の GaussianBlur（インストールされている場合のみ）"""
+    name = "opencv"
+    label = "OpenCV"
+    
+    @classmethod
+    def is_available(cls):
+        return importlib.util.find_spec("cv2") is not None
+    
+    def blur(self, data, sigma):
+        import cv2
+        
+        ksize = 2 * gaussian_radius(sigma) + 1
+        # gaussian_filter の mode="reflect" は BORDER_REFLECT に相当する
+        def run(plane):
+            return cv2.GaussianBlur(np.ascontiguousarray(plane), (ksize, ksize), sigma,
+                                    sigmaY=sigma, borderType=cv2.BORDER_REFLECT)
+        
+        if data.ndim == 2:
+            return run(data)
+        return np.stack([run(plane) for plane in data])
+
+
+# ---------------------------------------------------------------------------
+# ブラーバックエンドの自動キャリブレーション
+# ---------------------------------------------------------------------------
+
+CALIBRATION_CACHE_FILE = "blur_calibration.json"
+# sigmaの範囲（スライダーの0.1〜10.0）をいくつかの帯に分け、帯ごとに最速のバックエンドを選ぶ
+SIGMA_BANDS = ((0.1, 1.5, 0.8), (1.5, 4.0, 2.5), (4.0, 10.0, 7.0))  # (下限, 上限, 計測に使うsigma)
+CALIBRATION_SAMPLE_SIZE = 512
+# 参照実装 (gaussian_filter) との許容誤差（データ範囲に対する相対値）
+CALIBRATION_TOLERANCE = 1e-4
+
+
+def sigma_band(sigma):
+    """sigmaが属する帯の番号を返す"""
+    for i, (low, high, _) in enumerate(SIGMA_BANDS):
+        if sigma < high:
+            return i
+    return len(SIGMA_BANDS) - 1
+
+
+def calibration_keys(shape):
+    """キャッシュのキー（マシン単位、画像サイズ単位）を返す"""
+    machine_key = "|".join([
+        platform.node(), platform.machine(), str(os.cpu_count()),
+        f"numpy {np.__version__}", ",".join(sorted(available_blur_backends())),
+    ])
+    height, width = shape[-2:]
+    channels = shape[0] if len(shape) == 3 else 1
+    # 画素数は2のべき乗単位で丸める
+    size_key = f"{channels}x2^{int(round(np.log2(max(height * width, 1))))}"
+    return machine_key, size_key
+
+
+def calibration_sample(image):
+    """画像中央から計測用のサンプルを切り出して float32 で返す"""
+    height, width = image.shape[-2:]
+    size = CALIBRATION_SAMPLE_SIZE
+    top = max((height - size) // 2, 0)
+    left = max((width - size) // 2, 0)
+    return image[..., top:top + size, left:left + size].astype(np.float32)
+
+
+def calibrate_blur_backends(sample, repeats=2):
+    """各バックエンドの処理時間を計測し、sigmaの帯ごとに最速のバックエンドを選ぶ
+    
+    戻り値は (帯番号 -> バックエンド名 の辞書, 計測結果の辞書)
+    """
+    data_range = float(sample.max() - sample.min()) or 1.0
+    candidates = [name for name in available_blur_backends() if BLUR_BACKENDS[name].calibratable]
+    choice = {}
+    timings = {}
+    for band, (_, _, sigma) in enumerate(SIGMA_BANDS):
+        reference = gaussian_filter(sample, sigma=spatial_sigma(sample, sigma))
+        best_name, best_time = "scipy", None
+        for name in candidates:
+            backend = BLUR_BACKENDS[name]()
+            try:
+                result = backend.blur(sample, sigma)  # ウォームアップを兼ねる
+                error = float(np.max(np.abs(result - reference))) / data_range
+                if error > CALIBRATION_TOLERANCE:
+                    timings[f"{name}@{sigma}"] = None
+                    continue
+                elapsed = None
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    backend.blur(sample, sigma)
+                    t = time.perf_counter() - start
+                    elapsed = t if elapsed is None else min(elapsed, t)
+            except Exception:
+                timings[f"{name}@{sigma}"] = None
+                continue
+            timings[f"{name}@{sigma}"] = elapsed
+            if best_time is None or elapsed < best_time:
+                best_name, best_time = name, elapsed
+        choice[band] = best_name
+    return choice, timings
+
+
+class BlurEngine:
+    """バックエンドの選択（自動キャリブレーション結果または強制指定）とブラー処理を行う"""
+    
+    def __init__(self, siril=None, native_dtype=np.float32):
+        self.siril = siril
+        self.native_dtype = native_dtype
+        # None のときは自動選択
+        self.forced_backend = None
+        self.band_choice = {}
+        self._instances = {}
+    
+    def get_backend(self, name):
+        """バックエンドのインスタンスを返す（使い回す）"""
+        if name not in self._instances:
+            self._instances[name] = BLUR_BACKENDS[name](self.siril, self.native_dtype)
+        return self._instances[name]
+    
+    def backend_for(self, sigma):
+        """指定したsigmaで使うバックエンドを返す"""
+        name = self.forced_backend or self.band_choice.get(sigma_band(sigma), "scipy")
+        if name not in BLUR_BACKENDS or not BLUR_BACKENDS[name].is_available():
+            name = "scipy"
+        return self.get_backend(name)
+    
+    def blur(self, data, sigma):
+        return self.backend_for(sigma).blur(data, sigma)
+    
+    def blur_local(self, data, sigma):
+        """Sirilの画像を使わずにブラーをかける（切り出した画像や並列処理用）"""
+        backend = self.backend_for(sigma)
+        if backend.needs_command:
+            backend = self.get_backend("scipy")
+        return backend.blur(data, sigma)
+    
+    def calibrate(self, image, force=False):
+        """キャッシュを参照し、なければ画像のサンプルで計測してバックエンドを選ぶ
+        
+        計測を実行した場合は True を返す。
+        """
+        machine_key, size_key = calibration_keys(image.shape)
+        cache = load_json_cache(CALIBRATION_CACHE_FILE)
+        entry = cache.get(machine_key, {}).get(size_key)
+        if entry and not force:
+            self.band_choice = {int(k): v for k, v in entry["bands"].items()}
+            return False
+        
+        choice, timings = calibrate_blur_backends(calibration_sample(image))
+        self.band_choice = choice
+        cache.setdefault(machine_key, {})[size_key] = {
+            "bands": {str(k): v for k, v in choice.items()},
+            "timings": timings,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        save_json_cache(CALIBRATION_CACHE_FILE, cache)
+        return True
+    
+    def describe(self):
+        """選択状態を表す文字列を返す（ログ用）"""
+        if self.forced_backend:
+            return f"{self.forced_backend} (固定)"
+        parts = []
+        for band, (low, high, _) in enumerate(SIGMA_BANDS):
+            parts.append(f"{low:g}-{high:g}: {self.band_choice.get(band, 'scipy')}")
+        return ", ".join(parts)
+
+
+# ---------------------------------------------------------------------------
+# アンシャープマスクの計算
+# ---------------------------------------------------------------------------
+
+# 行ごとに分割して処理するときの1回分の作業量（float32換算のバイト数）。
+# 作業用の配列がCPUのキャッシュに収まる程度にして、メモリ帯域の消費を抑える
+STREAM_STRIP_BYTES = 4 * 1024 * 1024
+# 1回分の最小行数
+STREAM_MIN_ROWS = 16
+
+
+def dtype_max(dtype):
+    """データ型ごとの最大値（uint16は65535、floatは1.0）"""
+    return 65535.0 if dtype == np.uint16 else 1.0
+
+
+def clip_to_dtype(data, dtype):
+    """元データの型に合わせて範囲を制限して変換する"""
+    if dtype == np.uint16:
+        return np.clip(data, 0, 65535).astype(np.uint16)
+    return np.clip(data, 0.0, 1.0).astype(np.float32)
+
+
+def clip_into(data, out):
+    """float32 の data を out の型の範囲に制限しながら out へ書き込む（data は上書きされる）
+    
+    clip_to_dtype() と同じ結果を、新しい配列を作らずに得る。
+    """
+    np.clip(data, 0.0, dtype_max(out.dtype), out=data)
+    np.copyto(out, data, casting="unsafe")
+
+
+def strip_rows_for(shape, halo):
+    """行ごとに分割して処理するときの1回分の行数を返す"""
+    channels = shape[0] if len(shape) == 3 else 1
+    row_bytes = channels * shape[-1] * 4
+    # 余白の分の重複計算が多くなりすぎないよう、余白の6倍以上の行数にする
+    return max(STREAM_STRIP_BYTES // max(row_bytes, 1), 6 * halo, STREAM_MIN_ROWS)
+
+
+def sharpen(original, blurred, multi, threshold=0.0, weight=None, scale=1.0):
+    """アンシャープマスクを計算して float32 で返す
+    
+    threshold: |original - blurred| がこの値（データ範囲に対する比率）以下の画素は強調しない
+    weight: 強調の重み (height, width)。保護マスクから作る（0の画素は強調しない）
+    scale: データ範囲の最大値（uint16なら65535）
+    """
+    if threshold <= 0 and weight is None:
+        # 従来の式: out = in * (1 + amount) + filtered * (-amount)
+        return original * (1 + multi) - blurred * multi
+    
+    # out = in + amount * (in - filtered) を、マスクした画素を0にしながらその場で計算する
+    detail = original - blurred
+    if threshold > 0:
+        np.copyto(detail, 0.0, where=np.abs(detail) <= threshold * scale)
+    detail *= multi
+    if weight is not None:
+        # (height, width) の重みをチャンネル方向にブロードキャストする
+        detail *= weight
+    detail += original
+    return detail
+
+
+# ---------------------------------------------------------------------------
+# 処理結果の統計（クリップ数・ヒストグラム・エッジとノイズの増幅率）
+# ---------------------------------------------------------------------------
+
+# ヒストグラムとエッジ・ノイズの推定に使う行数（この行数になるよう一定間隔で行を抜き出す）
+STATS_SAMPLE_ROWS = 128
+STATS_HISTOGRAM_BINS = 128
+
+
+class SharpenStats:
+    """アンシャープマスクの計算と同時に集計する統計
+    
+    クリップされた画素数は範囲制限の直前の短冊で全画素について数え、ヒストグラムとエッジ・ノイズの
+    増幅率は一定間隔で抜き出した行（プロキシ）の処理前後の値から求める。
+    エッジの増幅率は隣接画素の差の二乗平均の比の平方根、ノイズの増幅率は隣接画素の差の絶対値の
+    中央値の比（背景が大部分を占める天体画像ではノイズの推定値になる）。
+    """
+    
+    def __init__(self, shape, dtype):
+        channels = shape[0] if len(shape) == 3 else 1
+        self.scale = dtype_max(dtype)
+        self.pixels = shape[-2] * shape[-1]
+        self.row_step = max(shape[-2] // STATS_SAMPLE_ROWS, 1)
+        self.clipped_low = np.zeros(channels, dtype=np.int64)
+        self.clipped_high = np.zeros(channels, dtype=np.int64)
+        self._before = []
+        self._after = []
+    
+    def count_clipped(self, data):
+        """範囲制限の前の float32 の短冊について、範囲外の画素数をチャンネルごとに数える"""
+        self.clipped_low += np.asarray(np.count_nonzero(data < 0, axis=(-2, -1))).reshape(-1)
+        self.clipped_high += np.asarray(np.count_nonzero(data > self.scale, axis=(-2, -1))).reshape(-1)
+    
+    def sample(self, before, after, top):
+        """top行目から始まる短冊のうち、抜き出す行の処理前後の値を集める"""
+        first = (-top) % self.row_step
+        if first >= before.shape[-2]:
+            return
+        self._before.append(before[..., first::self.row_step, :].astype(np.float32) / self.scale)
+        self._after.append(after[..., first::self.row_step, :].astype(np.float32) / self.scale)
+    
+    def clipped_fraction(self):
+        """クリップされた画素の割合（全チャンネルの合計）"""
+        return float(self.clipped_low.sum() + self.clipped_high.sum()) / (self.pixels * len(self.clipped_low))
+    
+    def histograms(self):
+        """処理前と処理後のヒストグラム（0〜1を等分、全チャンネルの合計）を返す"""
+        result = []
+        for rows in (self._before, self._after):
+            counts = np.zeros(STATS_HISTOGRAM_BINS, dtype=np.int64)
+            for data in rows:
+                counts += np.histogram(data, bins=STATS_HISTOGRAM_BINS, range=(0.0, 1.0))[0]
+            result.append(counts)
+        return tuple(result)
+    
+    def gains(self):
+        """(エッジの増幅率, ノイズの増幅率) を返す（プロキシがない場合は None）"""
+        if not self._before:
+            return None
+        before = np.concatenate([np.diff(data, axis=-1).ravel() for data in self._before])
+        after = np.concatenate([np.diff(data, axis=-1).ravel() for data in self._after])
+        edge_before = float(np.mean(before * before))
+        noise_before = float(np.median(np.abs(before)))
+        edge = float(np.sqrt(np.mean(after * after) / edge_before)) if edge_before > 0 else 1.0
+        noise = float(np.median(np.abs(after))) / noise_before if noise_before > 0 else 1.0
+        return edge, noise
+    
+    def describe_clipped(self):
+        """チャンネルごとのクリップ数を表す文字列を返す"""
+        names = ("R", "G", "B") if len(self.clipped_low) == 3 else ("L",) * len(self.clipped_low)
+        parts = []
+        for name, low, high in zip(names, self.clipped_low, self.clipped_high):
+            parts.append(f"{name} {int(low)}/{int(high)} ({(low + high) * 100 / self.pixels:.2f}%)")
+        return ", ".join(parts)
+    
+    def describe(self):
+        """ログ・表示用の文字列を返す"""
+        text = f"クリップ(黒/白): {self.describe_clipped()}"
+        gains = self.gains()
+        if gains is not None:
+            text += f"\nエッジ ×{gains[0]:.2f}, ノイズ ×{gains[1]:.2f}"
+        return text
+
+
+def histogram_qimage(before, after, width=256, height=64):
+    """処理前（灰色の塗り）と処理後（橙色の線）のヒストグラムを重ねた QImage を返す（縦軸は対数）"""
+    pixels = np.full((height, width, 3), 32, dtype=np.uint8)
+    columns = np.arange(width) * len(before) // width
+    peak = np.log1p(max(int(before.max()), int(after.max()), 1))
+    rows = np.arange(height)[:, None]
+    for counts, color, fill in ((before, (140, 140, 140), True), (after, (255, 150, 40), False)):
+        tops = height - 1 - (np.log1p(counts[columns]) / peak * (height - 1)).astype(int)
+        mask = rows >= tops[None, :] if fill else np.abs(rows - tops[None, :]) <= 0
+        pixels[mask] = color
+    image = QImage(pixels.data, width, height, width * 3, QImage.Format.Format_RGB888)
+    return image.copy()
+
+
+# ---------------------------------------------------------------------------
+# 星・ハイライトの保護マスク
+# ---------------------------------------------------------------------------
+
+# 保護範囲を広げる画素数と、境界をぼかすsigma
+PROTECTION_DILATION = 2
+PROTECTION_FEATHER = 1.5
+
+
+def compute_protection_weight(original, level):
+    """星やハイライトを保護するための重み (height, width) を float32 で返す
+    
+    最も明るいチャンネルが level（データ範囲に対する比率）以上の画素とその周囲を保護対象とし、
+    保護する画素は0、それ以外は1、境界はなめらかに変化させる。
+    """
+    ndimage = lazy_scipy("ndimage")
+    luminance = original.max(axis=0) if original.ndim == 3 else original
+    mask = luminance >= level * dtype_max(original.dtype)
+    if PROTECTION_DILATION > 0 and mask.any():
+        mask = ndimage.binary_dilation(mask, iterations=PROTECTION_DILATION)
+    weight = ndimage.gaussian_filter(mask.astype(np.float32), PROTECTION_FEATHER)
+    np.subtract(1.0, weight, out=weight)
+    return weight
+
+
+class ProtectionMaskCache:
+    """保護マスクを元画像ごとにキャッシュする（元画像が変わると破棄する）"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._source = None
+        self._weights = {}
+    
+    def get(self, original, level):
+        with self._lock:
+            if self._source is not original:
+                self._source = original
+                self._weights = {}
+            key = round(float(level), 4)
+            if key not in self._weights:
+                self._weights[key] = compute_protection_weight(original, key)
+            return self._weights[key]
+    
+    def clear(self):
+        with self._lock:
+            self._source = None
+            self._weights = {}
+
+
+# ---------------------------------------------------------------------------
+# マルチスケール（複数のsigmaのアンシャープマスクを1回で適用）
+# ---------------------------------------------------------------------------
+
+# スケールスペースで前の段の結果にブラーを重ねてよい最小のsigma。これより小さいsigmaを
+# 含む合成は、scipyの離散カーネルでは直接かけた場合とデータ範囲の数%も異なる（1.0以上なら
+# 16bitで数カウント以内）
+SCALE_SPACE_MIN_SIGMA = 1.0
+
+def parse_layers(text):
+    """ "sigma:multi, sigma:multi" 形式のレイヤー指定を [(sigma, multi), ...] に変換する
+    
+    値が不正な場合は ValueError を送出する。
+    """
+    layers = []
+    for item in text.replace("、", ",").split(","):
+        if not item.strip():
+            continue
+        sigma_text, _, multi_text = item.partition(":")
+        sigma, multi = float(sigma_text), float(multi_text)
+        if not (0.1 <= sigma <= 10.0):
+            raise ValueError(f"Sigmaの値が範囲外です (0.1-10.0): {sigma}")
+        if not (0.0 <= multi <= 5.0):
+            raise ValueError(f"Multiの値が範囲外です (0.0-5.0): {multi}")
+        layers.append((sigma, multi))
+    if not layers:
+        raise ValueError("レイヤーを1つ以上指定してください (例: 1.0:0.8, 3.0:0.4)")
+    return layers
+
+
+def describe_layers(layers):
+    """レイヤーの指定を表す文字列を返す（ログ・undo用）"""
+    if len(layers) == 1:
+        sigma, multi = layers[0]
+        return f"sigma={sigma:.2f}, multi={multi:.2f}"
+    return "layers=" + "+".join(f"{sigma:.2f}:{multi:.2f}" for sigma, multi in layers)
+
+
+def scale_space_steps(sigmas):
+    """sigmaの小さい順に、各sigmaのブラー画像をどこから何のsigmaで求めるかを返す
+    
+    ガウシアンの合成 G(σ2) = G(√(σ2² - σ1²)) * G(σ1) を利用して前の段の結果に差分のブラーを
+    重ねる。ただし前の段か差分のsigmaが SCALE_SPACE_MIN_SIGMA より小さいと、離散化した
+    カーネルでは合成が成り立たず大きな差が出るので、元の画像から直接ブラーをかける。
+    戻り値は [(sigma, 元にするsigma（0.0は元の画像）, かけるsigma)]
+    """
+    steps = []
+    previous = 0.0
+    for sigma in sorted(set(sigmas)):
+        step = float(np.sqrt(sigma * sigma - previous * previous))
+        if previous >= SCALE_SPACE_MIN_SIGMA and step >= SCALE_SPACE_MIN_SIGMA:
+            steps.append((sigma, previous, step))
+        else:
+            steps.append((sigma, 0.0, sigma))
+        previous = sigma
+    return steps
+
+
+def scale_space_halo(sigmas):
+    """スケールスペースの計算に必要な余白（重ねてかけるカーネル半径の合計の最大）を返す"""
+    depth = {0.0: 0}
+    for sigma, source, step in scale_space_steps(sigmas):
+        depth[sigma] = depth[source] + gaussian_radius(step)
+    return max(depth.values())
+
+
+def blur_scale_space(data, sigmas, blur):
+    """すべてのsigmaのブラー画像を、できるだけ前の段の結果に差分のブラーを重ねて計算する
+    
+    戻り値は sigma -> ブラー画像 の辞書。重ねて求めた段は、直接ブラーをかけた結果と
+    離散化と打ち切りのぶん少し異なる（scale_space_steps() を参照）。
+    """
+    blurred = {0.0: data}
+    for sigma, source, step in scale_space_steps(sigmas):
+        blurred[sigma] = blur(blurred[source], step)
+    del blurred[0.0]
+    return blurred
+
+
+def sharpen_layers(original, layers, blurred, threshold=0.0, weight=None, scale=1.0):
+    """複数レイヤーのアンシャープマスクを1回の累積で計算して float32 で返す
+    
+    out = in + Σ multi_i * (in - blur_i) を、作業用配列を使い回しながらその場で計算する。
+    thresholdは各レイヤーの |in - blur_i| に対して判定する。
+    """
+    if len(layers) == 1:
+        sigma, multi = layers[0]
+        return sharpen(original, blurred[sigma], multi, threshold, weight, scale)
+    
+    total = np.zeros_like(original)
+    detail = np.empty_like(original)
+    for sigma, multi in layers:
+        np.subtract(original, blurred[sigma], out=detail)
+        if threshold > 0:
+            np.copyto(detail, 0.0, where=np.abs(detail) <= threshold * scale)
+        detail *= multi
+        total += detail
+    if weight is not None:
+        total *= weight
+    total += original
+    return total
+
+
+def unsharp_streamed(original, layers, blur, out=None, strip_rows=None, progress=None,
+                     threshold=0.0, weight=None, stats=None):
+    """元データの型のまま、行方向の短冊ごとにアンシャープマスクを計算して out に書き込む
+    
+    layers は [(sigma, multi), ...]。float32 への変換は短冊（とブラー用の余白）の範囲だけで行い、
+    範囲制限と元の型への変換は短冊の出力時にまとめて行う。そのため画像全体の float32 の
+    コピーを作らずに済み、uint16 画像では作業メモリが大幅に減る（float32 の画像は短冊を
+    コピーせずにそのまま使う）。余白はブラーの影響範囲分
+    付けるので、結果は画像全体を一度に処理した場合と一致する。
+    
+    strip_rows を省略するとキャッシュに収まる行数を自動で決める。progress(処理済み行数, 全行数)
+    は短冊ごとに呼ばれ、例外を送出すると処理を中断できる。stats に SharpenStats を渡すと、
+    短冊がキャッシュにある間に統計も集計する。
+    """
+    height = original.shape[-2]
+    halo = scale_space_halo([sigma for sigma, _ in layers])
+    scale = dtype_max(original.dtype)
+    if out is None:
+        out = np.empty(original.shape, dtype=original.dtype)
+    if strip_rows is None:
+        strip_rows = strip_rows_for(original.shape, halo)
+    for top in range(0, height, strip_rows):
+        bottom = min(top + strip_rows, height)
+        src_top = max(top - halo, 0)
+        src_bottom = min(bottom + halo, height)
+        
+        strip = original[..., src_top:src_bottom, :].astype(np.float32, copy=False)
+        blurred = blur_scale_space(strip, [sigma for sigma, _ in layers], blur)
+        
+        # 余白を除いた部分だけを出力する
+        inner = slice(top - src_top, bottom - src_top)
+        strip_weight = weight[top:bottom] if weight is not None else None
+        blurred = {sigma: data[..., inner, :] for sigma, data in blurred.items()}
+        unsharp = sharpen_layers(strip[..., inner, :], layers, blurred, threshold, strip_weight, scale)
+        if stats is not None:
+            stats.count_clipped(unsharp)
+        # sharpen_layers() は常に新しい配列を返すので、その場で範囲制限してよい
+        clip_into(unsharp, out[..., top:bottom, :])
+        if stats is not None:
+            stats.sample(strip[..., inner, :], out[..., top:bottom, :], top)
+        
+        if progress is not None:
+            progress(bottom, height)
+    return out
+
+
+# ---------------------------------------------------------------------------
+# 元画像と出力バッファ
+# ---------------------------------------------------------------------------
+
+# 再利用のために保持しておく出力バッファの数
+OUTPUT_BUFFERS = 2
+
+
+class SourceBuffers:
+    """元画像1枚分のバッファ（変更しない元画像・再利用する出力バッファ）を管理する
+    
+    元画像は書き込み禁止にして、プレビュー・リセット・確定の間でコピーせずに共有する。
+    float32 への変換は unsharp_streamed() が短冊ごとに行う（float32 の画像は元画像をそのまま
+    使い、uint16 の画像でも画像全体の float32 のコピーは作らない）。出力バッファは返却された
+    ものを次の計算で再利用する。
+    """
+    
+    def __init__(self, original, max_free=OUTPUT_BUFFERS):
+        original.setflags(write=False)
+        self.original = original
+        self.max_free = max_free
+        # 新しく確保した画像サイズの配列の数（adopt() で引き継ぐ）
+        self.allocations = 0
+        self._free = []
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """出力バッファを返す（返却されたものがあれば再利用する）"""
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocations += 1
+        return np.empty(self.original.shape, dtype=self.original.dtype)
+    
+    def release(self, buffer):
+        """使い終わった出力バッファを返却する（元画像になったものなど書き込み禁止の配列は受け取らない）"""
+        if (buffer.shape != self.original.shape or buffer.dtype != self.original.dtype
+                or not buffer.flags.writeable):
+            return
+        with self._lock:
+            if len(self._free) < self.max_free and all(free is not buffer for free in self._free):
+                self._free.append(buffer)
+    
+    @property
+    def pooled_bytes(self):
+        """再利用のために保持している出力バッファのバイト数"""
+        with self._lock:
+            return sum(buffer.nbytes for buffer in self._free)
+    
+    def adopt(self, original):
+        """確定した結果を新しい元画像にする（返却済みの出力バッファは引き継ぐ）"""
+        buffers = SourceBuffers(original, self.max_free)
+        with self._lock:
+            free, self._free = self._free, []
+            buffers.allocations = self.allocations
+        for buffer in free:
+            buffers.release(buffer)
+        return buffers
+
+
+# ---------------------------------------------------------------------------
+# パラメータの履歴・プリセットと結果のキャッシュ
+# ---------------------------------------------------------------------------
+
+PRESETS_FILE = "presets.json"
+HISTORY_SIZE = 20
+# 結果のキャッシュの上限（圧縮後のバイト数と、再利用のために保持する出力バッファの合計）
+RESULT_CACHE_BYTES = 512 * 1024 * 1024
+# 圧縮せずに保持する最近の結果の数（それより古いものは可逆圧縮する）
+RESULT_CACHE_RAW_ENTRIES = 2
+
+
+def make_params(layers, threshold=0.0, protect=None):
+    """パラメータ一式を JSON に保存できる辞書にする"""
+    return {
+        "layers": [[float(sigma), float(multi)] for sigma, multi in layers],
+        "threshold": float(threshold),
+        "protect": None if protect is None else float(protect),
+    }
+
+
+def params_key(params):
+    """パラメータ一式を比較・キャッシュのキーに使う文字列にする"""
+    return json.dumps(params, sort_keys=True)
+
+
+def describe_params(params):
+    """パラメータ一式を表す文字列を返す（ログ・undo・履歴用）"""
+    description = describe_layers(params["layers"])
+    if params.get("threshold", 0.0) > 0:
+        description += f", threshold={params['threshold']:.3f}"
+    if params.get("protect") is not None:
+        description += f", protect={params['protect']:.2f}"
+    return description
+
+
+def load_presets():
+    """保存したプリセット（名前 -> パラメータ一式）を読み込む"""
+    return load_json_cache(PRESETS_FILE)
+
+
+def save_presets(presets):
+    save_json_cache(PRESETS_FILE, presets)
+
+
+def pack_array(data):
+    """配列をバイト単位に並べ替えてからzlibで圧縮する（可逆。画像は上位バイトがそろうので縮みやすい）"""
+    data = np.ascontiguousarray(data)
+    planes = data.reshape(-1).view(np.uint8).reshape(-1, data.itemsize).T
+    return zlib.compress(np.ascontiguousarray(planes).tobytes(), 1)
+
+
+def unpack_array(packed, shape, dtype):
+    """pack_array() で圧縮した配列を元に戻す"""
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(zlib.decompress(packed), dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+
+
+class ResultCache:
+    """パラメータごとの計算結果を、合計サイズに上限を付けて最近使った順に保持する
+    
+    最近の raw_entries 個はそのまま、それより古いものは別スレッドで可逆圧縮して保持し、
+    上限を超えると最も古いものから破棄する。上限より大きい結果は保持しない。
+    release(配列) を指定すると、圧縮・破棄して保持しなくなった結果の配列を、上限に収まる
+    場合だけ渡す（出力バッファの再利用用）。pooled() は release で渡した配列のうち
+    再利用のために保持されているバイト数を返し、上限にはその分も含める。
+    """
+    
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, raw_entries=RESULT_CACHE_RAW_ENTRIES, release=None,
+                 pooled=None):
+        self.max_bytes = max_bytes
+        self.raw_entries = raw_entries
+        self.release = release
+        self.pooled = pooled
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._compressor = ThreadPoolExecutor(max_workers=1)
+    
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+    
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(entry["size"] for entry in self._entries.values())
+    
+    def get(self, key):
+        """(結果, 統計) を返す。ない場合は None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            if entry["data"] is None:
+                entry["data"] = unpack_array(entry["packed"], entry["shape"], entry["dtype"])
+                entry["packed"] = None
+                entry["size"] = entry["data"].nbytes
+                entry["compressing"] = False
+                self._trim()
+            result = entry["data"], entry["stats"]
+        self._schedule_compression()
+        return result
+    
+    def put(self, key, data, stats=None):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None and previous["data"] is not data:
+                self._release(previous)
+            if data.nbytes > self.max_bytes:
+                return
+            self._entries[key] = {"data": data, "packed": None, "shape": data.shape, "dtype": data.dtype,
+                                  "stats": stats, "size": data.nbytes, "compressing": False}
+            self._entries.move_to_end(key)
+            self._trim()
+        self._schedule_compression()
+    
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            for entry in entries:
+                self._release(entry)
+    
+    def flush(self):
+        """予定している圧縮がすべて終わるまで待つ（計測用）"""
+        self._compressor.submit(lambda: None).result()
+    
+    def close(self):
+        """圧縮用のスレッドを止める（以後は使えない）"""
+        self._compressor.shutdown(wait=True, cancel_futures=True)
+    
+    def _total(self):
+        total = sum(entry["size"] for entry in self._entries.values())
+        return total + (self.pooled() if self.pooled is not None else 0)
+    
+    def _release(self, entry):
+        # 再利用のために保持すると上限を超える場合は渡さずに捨てる
+        data = entry["data"]
+        if self.release is not None and data is not None and self._total() + data.nbytes <= self.max_bytes:
+            self.release(data)
+    
+    def _trim(self):
+        while self._entries and self._total() > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._release(entry)
+    
+    def _schedule_compression(self):
+        with self._lock:
+            old = list(self._entries.items())[:max(len(self._entries) - self.raw_entries, 0)]
+            targets = [(key, entry["data"]) for key, entry in old
+                       if entry["data"] is not None and not entry["compressing"]]
+            for key, _ in targets:
+                self._entries[key]["compressing"] = True
+        for key, data in targets:
+            self._compressor.submit(self._compress, key, data)
+    
+    def _compress(self, key, data):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["data"] is not data:
+                return
+        packed = pack_array(data)
+        with self._lock:
+            entry = self._entries.get(key)
+            recent = list(self._entries)[max(len(self._entries) - self.raw_entries, 0):]
+            # 圧縮中に使われた（最近のものになった）場合や破棄された場合はそのままにする
+            if entry is None or entry["data"] is not data or key in recent:
+                return
+            released = dict(entry)
+            entry["data"] = None
+            entry["packed"] = packed
+            entry["size"] = len(packed)
+            self._release(released)
+            self._trim()
+
+
+# ---------------------------------------------------------------------------
+# パラメータのグリッド比較
+# ---------------------------------------------------------------------------
+
+GRID_THUMBNAIL_SIZE = 160
+# 一度に比較できる sigma・multi の数の上限
+GRID_MAX_VALUES = 8
+
+
+def parse_float_list(text):
+    """カンマ区切りの数値リストを解析する"""
+    return [float(v) for v in text.replace("、", ",").split(",") if v.strip()]
+
+
+def crop_with_halo(original, top, left, size, halo):
+    """切り出し範囲にブラー用の余白を付けて float32 で切り出す
+    
+    戻り値は (余白付きの画像, 余白を除いた範囲を表すインデックス)
+    """
+    height, width = original.shape[-2:]
+    bottom = min(top + size, height)
+    right = min(left + size, width)
+    src_top = max(top - halo, 0)
+    src_left = max(left - halo, 0)
+    src_bottom = min(bottom + halo, height)
+    src_right = min(right + halo, width)
+    region = original[..., src_top:src_bottom, src_left:src_right].astype(np.float32)
+    inner = (Ellipsis, slice(top - src_top, bottom - src_top), slice(left - src_left, right - src_left))
+    return region, inner
+
+
+def render_parameter_grid(original, crop, sigmas, multis, blur, publish, check_cancelled=None,
+                          threshold=0.0, weight=None):
+    """sigma×multi の組み合わせの結果を計算し、1枚できるごとに publish(行, 列, 画像) を呼ぶ
+    
+    sigmaごとのブラーは1回だけ計算して同じ行のすべてのmultiで使い回す。行は並列に計算する。
+    """
+    top, left, size = crop
+    region, inner = crop_with_halo(original, top, left, size, max(gaussian_radius(v) for v in sigmas))
+    source = region[inner]
+    if weight is not None:
+        weight = weight[top:top + size, left:left + size]
+    scale = dtype_max(original.dtype)
+    
+    def render_row(row, sigma):
+        if check_cancelled is not None:
+            check_cancelled()
+        blurred = blur(region, sigma)[inner]
+        for column, multi in enumerate(multis):
+            if check_cancelled is not None:
+                check_cancelled()
+            unsharp = sharpen(source, blurred, multi, threshold, weight, scale)
+            publish(row, column, clip_to_dtype(unsharp, original.dtype))
+    
+    with ThreadPoolExecutor(max_workers=min(len(sigmas), os.cpu_count() or 1)) as pool:
+        futures = [pool.submit(render_row, row, sigma) for row, sigma in enumerate(sigmas)]
+        for future in futures:
+            future.result()
+
+
+def display_range(data):
+    """表示用の階調範囲（下位0.5%〜上位0.1%を除いた範囲）を返す"""
+    low, high = np.percentile(data, (0.5, 99.9))
+    if high <= low:
+        high = low + 1
+    return float(low), float(high)
+
+
+def to_qimage(data, low, high):
+    """画像データを表示用の8bit QImage に変換する"""
+    scaled = np.clip((data.astype(np.float32) - low) * (255.0 / (high - low)), 0, 255).astype(np.uint8)
+    if scaled.ndim == 3 and scaled.shape[0] == 3:
+        # (channels, height, width) -> (height, width, channels)
+        pixels = np.ascontiguousarray(np.moveaxis(scaled, 0, -1))
+        image_format = QImage.Format.Format_RGB888
+    else:
+        pixels = np.ascontiguousarray(scaled[0] if scaled.ndim == 3 else scaled)
+        image_format = QImage.Format.Format_Grayscale8
+    height, width = pixels.shape[:2]
+    image = QImage(pixels.data, width, height, pixels.strides[0], image_format)
+    # QImage は元のバッファを参照するのでコピーして切り離す
+    return image.copy()
+
+
+# ---------------------------------------------------------------------------
+# パラメータの自動調整
+# ---------------------------------------------------------------------------
+
+AUTOTUNE_TILE_SIZE = 256
+AUTOTUNE_TILES = 6
+AUTOTUNE_SIGMAS = (0.5, 0.8, 1.2, 1.8, 2.7, 4.0)
+AUTOTUNE_MAX_MULTI = 5.0
+# multiの二分探索の回数（5.0 / 2^10 ≒ 0.005 の精度）
+AUTOTUNE_STEPS = 10
+AUTOTUNE_CLIP_BUDGET = 0.0005
+AUTOTUNE_NOISE_BUDGET = 1.5
+
+
+def representative_tiles(original, count=AUTOTUNE_TILES, size=AUTOTUNE_TILE_SIZE):
+    """構造（星・天体）の多いタイルと背景のタイルを半分ずつ選び、([(top, left), ...], タイルの大きさ) を返す"""
+    height, width = original.shape[-2:]
+    size = min(size, height, width)
+    # 標準偏差は間引いた画像で求める
+    step = max(size // 64, 1)
+    luminance = original[..., ::step, ::step]
+    if luminance.ndim == 3:
+        luminance = luminance.max(axis=0)
+    candidates = [(top, left) for top in range(0, height - size + 1, size)
+                  for left in range(0, width - size + 1, size)]
+    scores = [float(np.std(luminance[top // step:(top + size) // step, left // step:(left + size) // step]))
+              for top, left in candidates]
+    order = list(np.argsort(scores))
+    structured = order[::-1][:(count + 1) // 2]
+    # 背景は標準偏差が中央値に近いタイル（空の領域や画像の端を避ける）
+    middle = len(order) // 2
+    background = order[max(middle - count // 4, 0):][:count // 2]
+    chosen = list(dict.fromkeys(int(i) for i in structured + background))
+    return [candidates[i] for i in chosen], size
+
+
+def autotune_parameters(original, blur, clip_budget=AUTOTUNE_CLIP_BUDGET, noise_budget=AUTOTUNE_NOISE_BUDGET,
+                        sigmas=AUTOTUNE_SIGMAS, threshold=0.0, weight=None, progress=None):
+    """クリップされる画素の割合とノイズの増幅率の上限を守りながら、最も強くシャープにする sigma と multi を探す
+    
+    代表的なタイルだけで計算し、タイルを縦に並べたプロキシ画像として SharpenStats で評価する。
+    各sigmaのブラーはスケールスペースで1回だけ計算し、multiの二分探索（クリップとノイズは
+    multiに対して単調に増える）の間は使い回す。最もエッジが強くなるsigmaを選ぶ。
+    戻り値は {"sigma", "multi", "clipped", "edge", "noise", "evaluations", "candidates"} の辞書。
+    progress(処理済みのsigmaの数, sigmaの数) は例外を送出して中断できる。
+    """
+    tiles, size = representative_tiles(original)
+    scale = dtype_max(original.dtype)
+    halo = scale_space_halo(sigmas)
+    prepared = []
+    for top, left in tiles:
+        region, inner = crop_with_halo(original, top, left, size, halo)
+        blurred = blur_scale_space(region, sigmas, blur)
+        tile_weight = weight[top:top + size, left:left + size] if weight is not None else None
+        prepared.append((region[inner], {sigma: data[inner] for sigma, data in blurred.items()}, tile_weight))
+    proxy_shape = prepared[0][0].shape[:-2] + (size * len(prepared), size)
+    evaluations = 0
+    
+    def evaluate(sigma, multi):
+        nonlocal evaluations
+        evaluations += 1
+        stats = SharpenStats(proxy_shape, original.dtype)
+        for index, (source, blurred, tile_weight) in enumerate(prepared):
+            unsharp = sharpen(source, blurred[sigma], multi, threshold, tile_weight, scale)
+            stats.count_clipped(unsharp)
+            stats.sample(source, clip_to_dtype(unsharp, original.dtype), index * size)
+        edge, noise = stats.gains()
+        return stats.clipped_fraction(), edge, noise
+    
+    def feasible(result):
+        clipped, _, noise = result
+        return clipped <= clip_budget and noise <= noise_budget
+    
+    candidates = []
+    for done, sigma in enumerate(sigmas):
+        low, high = 0.0, AUTOTUNE_MAX_MULTI
+        best = evaluate(sigma, high)
+        if feasible(best):
+            low = high
+        else:
+            best = evaluate(sigma, low)
+            for _ in range(AUTOTUNE_STEPS):
+                middle = (low + high) / 2
+                result = evaluate(sigma, middle)
+                if feasible(result):
+                    low, best = middle, result
+                else:
+                    high = middle
+        clipped, edge, noise = best
+        candidates.append({"sigma": sigma, "multi": low, "clipped": clipped, "edge": edge, "noise": noise})
+        if progress is not None:
+            progress(done + 1, len(sigmas))
+    
+    chosen = max(candidates, key=lambda candidate: candidate["edge"])
+    return dict(chosen, evaluations=evaluations, candidates=candidates)
+
+
+# ---------------------------------------------------------------------------
+# Sirilとのやり取り（画像ロックを保持する時間を最小にする）
+# ---------------------------------------------------------------------------
+
+# Sirilが処理中・ダイアログ表示中の場合に再試行するまでの待ち時間（秒）
+SESSION_RETRY_DELAYS = (0.05, 0.1, 0.2, 0.4, 0.8)
+# プレビューは次の入力でやり直せるので、短く待って諦める
+SESSION_PREVIEW_RETRY_DELAYS = (0.02, 0.05, 0.1)
+SESSION_RETRY_ERRORS = (ProcessingThreadBusyError, ImageDialogOpenError)
+
+
+def siril_session(siril):
+    """siril に対応する SirilSession を返す（同じSirilInterfaceには同じセッションを使う）
+    
+    セッションは SirilInterface 自体に持たせるので、SirilInterface と一緒に破棄される。
+    """
+    session = getattr(siril, "_unsharp_session", None)
+    if session is None:
+        session = siril._unsharp_session = SirilSession(siril)
+    return session
+
+
+class SirilSession:
+    """Sirilとの画素データの受け渡しをまとめ、画像ロックを保持する時間を最小にする
+    
+    入力画像は snapshot() で1回だけ取得し、計算はすべてロックの外で行う。ロックは画素データの
+    受け渡しの間だけ保持し、Sirilが処理中・ダイアログ表示中の場合は間隔を空けて再試行する。
+    受け渡しの種類（label）ごとに、ロックを待った時間・保持した時間・再試行の回数を集計する。
+    """
+    
+    def __init__(self, siril, retry_delays=SESSION_RETRY_DELAYS):
+        self.siril = siril
+        self.retry_delays = retry_delays
+        # listener(label, 待ち時間, 保持時間, 再試行の回数) はロックを解放するたびに呼ばれる
+        self.listener = None
+        self._metrics = {}
+        self._lock = threading.Lock()
+    
+    def _retry(self, label, func, delays):
+        delays = self.retry_delays if delays is None else delays
+        for attempt in range(len(delays) + 1):
+            try:
+                return func(), attempt
+            except SESSION_RETRY_ERRORS:
+                if attempt == len(delays):
+                    self._update(label, None, None, attempt)
+                    raise
+                time.sleep(delays[attempt])
+    
+    def locked(self, label, func, delays=None):
+        """func() を画像ロック内で実行して結果を返す"""
+        timing = {}
+        
+        def run():
+            with self.siril.image_lock():
+                timing["locked"] = time.perf_counter()
+                try:
+                    return func()
+                finally:
+                    timing["hold"] = time.perf_counter() - timing["locked"]
+        
+        requested = time.perf_counter()
+        result, retries = self._retry(label, run, delays)
+        self._update(label, timing["locked"] - requested, timing["hold"], retries)
+        return result
+    
+    def command(self, *args, delays=None):
+        """Sirilのコマンドを実行する（cmd() はロック内で実行してはいけない）"""
+        return self._retry("cmd", lambda: self.siril.cmd(*args), delays)[0]
+    
+    def snapshot(self, label="snapshot", delays=None):
+        """Sirilの画像の画素データを取得する"""
+        return self.locked(label, self.siril.get_image_pixeldata, delays)
+    
+    def push(self, data, label="push", undo_message=None, delays=None):
+        """画素データをSirilに送る（undo_message を指定すると、先にundo状態を保存する）"""
+        # 再試行するのは画素データの受け渡しだけで、undo状態は1回だけ保存する
+        undo_saved = undo_message is None
+        
+        def hand_off():
+            nonlocal undo_saved
+            if not undo_saved:
+                self.siril.undo_save_state(undo_message)
+                undo_saved = True
+            self.siril.set_image_pixeldata(data)
+        self.locked(label, hand_off, delays)
+    
+    def save_undo(self, message, delays=None):
+        """undo状態を保存する（undo_save_state は画像ロック内で実行する必要がある）"""
+        self.locked("undo", lambda: self.siril.undo_save_state(message), delays)
+    
+    def _update(self, label, wait, hold, retries):
+        with self._lock:
+            entry = self._metrics.setdefault(label, {"count": 0, "wait": 0.0, "hold": 0.0, "hold_max": 0.0,
+                                                     "retries": 0, "failures": 0})
+            entry["retries"] += retries
+            if hold is None:
+                entry["failures"] += 1
+            else:
+                entry["count"] += 1
+                entry["wait"] += wait
+                entry["hold"] += hold
+                entry["hold_max"] = max(entry["hold_max"], hold)
+        if hold is not None and self.listener is not None:
+            self.listener(label, wait, hold, retries)
+    
+    def metrics(self):
+        """受け渡しの種類ごとの集計（回数・待ち時間と保持時間の合計・保持時間の最大・再試行・失敗）"""
+        with self._lock:
+            return {label: dict(entry) for label, entry in self._metrics.items()}
+    
+    def describe_metrics(self):
+        """集計をログ用の文字列にする"""
+        parts = []
+        for label, entry in sorted(self.metrics().items()):
+            count = max(entry["count"], 1)
+            parts.append(f"{label} {entry['count']}回 保持 平均{entry['hold'] / count * 1000:.1f}ms "
+                         f"最大{entry['hold_max'] * 1000:.1f}ms 待ち 平均{entry['wait'] / count * 1000:.1f}ms"
+                         + (f" 再試行{entry['retries']}回" if entry["retries"] else "")
+                         + (f" 失敗{entry['failures']}回" if entry["failures"] else ""))
+        return ", ".join(parts)
+
+
+# ---------------------------------------------------------------------------
+# テスト画像とSirilの代替（ヘッドレス実行用）
+# ---------------------------------------------------------------------------
+
+def make_test_image(shape, dtype=np.uint16, seed=0):
+    """背景・ノイズ・星を含む天体画像風のテスト画像を作る（同じseedなら同じ画像になる）"""
+    rng = np.random.default_rng(seed)
+    height, width = shape[-2:]
+    channels = shape[0] if len(shape) == 3 else 1
+    image = rng.normal(0.08, 0.01, (channels, height, width)).astype(np.float32)
+    # 星（ガウス形状）を5000画素に1個程度置く
+    for _ in range(max(height * width // 5000, 1)):
+        y, x = rng.uniform(0, height), rng.uniform(0, width)
+        fwhm = rng.uniform(1.5, 5.0)
+        peak = rng.uniform(0.05, 1.2)
+        radius = int(fwhm * 2) + 1
+        top, bottom = max(int(y) - radius, 0), min(int(y) + radius + 1, height)
+        left, right = max(int(x) - radius, 0), min(int(x) + radius + 1, width)
+        yy, xx = np.mgrid[top:bottom, left:right]
+        star = peak * np.exp(-4 * np.log(2) * ((yy - y) ** 2 + (xx - x) ** 2) / fwhm ** 2)
+        image[:, top:bottom, left:right] += star.astype(np.float32) * rng.uniform(0.8, 1.0, (channels, 1, 1))
+    image = clip_to_dtype(image * dtype_max(dtype), np.dtype(dtype))
+    return image if len(shape) == 3 else image[0]
+
+
+class LocalFit:
+    """LocalSirilInterface.get_image() が返す画像（sirilpy の FFit の代わり）"""
+    
+    def __init__(self, data):
+        self.data = data
+
+
+class LocalSirilInterface:
+    """メモリ上の画像に対して動作する SirilInterface の代替
+    
+    操作の再生やベンチマークをSirilなしで実行するために使う。画素データの受け渡しは
+    実際のSirilと同じくコピーとして扱い、受け渡したバイト数を数える。
+    unsharp コマンドは gaussian_filter で同じ計算を行う。
+    """
+    
+    def __init__(self, image, verbose=False):
+        self.image = image.copy()
+        self.verbose = verbose
+        self.messages = []
+        self.undo_stack = []
+        self._lock = threading.Lock()
+        self.reset_counters()
+    
+    def reset_counters(self):
+        """受け渡し・ファイル入出力のバイト数の計数をリセットする"""
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_saved = 0
+        self.bytes_loaded = 0
+    
+    def bytes_moved(self):
+        return self.bytes_sent + self.bytes_received + self.bytes_saved + self.bytes_loaded
+    
+    def connect(self):
+        return True
+    
+    def disconnect(self):
+        pass
+    
+    def log(self, message):
+        self.messages.append(message)
+        if self.verbose:
+            print(message)
+    
+    def error_messagebox(self, message):
+        self.log(f"[error] {message}")
+    
+    def info_messagebox(self, message):
+        self.log(f"[info] {message}")
+    
+    def is_image_loaded(self):
+        return self.image is not None
+    
+    @contextlib.contextmanager
+    def image_lock(self):
+        if not self._lock.acquire(timeout=30):
+            raise ProcessingThreadBusyError("image lock timeout")
+        try:
+            yield
+        finally:
+            self._lock.release()
+    
+    def get_image(self, with_pixels=True):
+        if not with_pixels:
+            return LocalFit(None)
+        self.bytes_received += self.image.nbytes
+        return LocalFit(self.image.copy())
+    
+    def get_image_pixeldata(self):
+        self.bytes_received += self.image.nbytes
+        return self.image.copy()
+    
+    def set_image_pixeldata(self, data):
+        self.bytes_sent += data.nbytes
+        self.image = np.array(data, copy=True)
+    
+    def undo_save_state(self, message):
+        self.undo_stack.append((message, self.image.copy()))
+    
+    def cmd(self, *args):
+        command = args[0].split() + list(args[1:]) if args else []
+        name = command[0] if command else ""
+        if name == "requires":
+            return
+        if name == "unsharp":
+            sigma, multi = float(command[1]), float(command[2])
+            original = self.image.astype(np.float32)
+            blurred = gaussian_filter(original, sigma=spatial_sigma(original, sigma))
+            if multi == 0:
+                # Sirilの unsharp は multi=0 のときガウシアンブラーのみを行う（SirilBlurBackend が利用する）
+                self.image = clip_to_dtype(blurred, self.image.dtype)
+            else:
+                self.image = clip_to_dtype(original * (1 + multi) - blurred * multi, self.image.dtype)
+            return
+        if name == "save":
+            with open(command[1], "wb") as f:
+                np.save(f, self.image)
+            self.bytes_saved += self.image.nbytes
+            return
+        if name == "load":
+            with open(command[1], "rb") as f:
+                self.image = np.load(f)
+            self.bytes_loaded += self.image.nbytes
+            return
+        raise s.CommandError(f"LocalSirilInterface: 未対応のコマンドです: {name}")
+
+
+# ---------------------------------------------------------------------------
+# 操作の記録（遅延の再現用）
+# ---------------------------------------------------------------------------
+
+SESSION_LOG_VERSION = 1
+
+
+class SessionRecorder:
+    """GUIの操作・プレビューのスケジュール判断・処理時間を JSON Lines で記録する
+    
+    path が None の場合はメモリ上にだけ記録する（再生時の集計用）。
+    """
+    
+    def __init__(self, path=None):
+        self.path = path
+        self.events = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8") if path else None
+    
+    def record(self, event_type, **fields):
+        event = {"t": round(time.perf_counter() - self.start, 6), "type": event_type}
+        event.update(fields)
+        with self._lock:
+            self.events.append(event)
+            if self._file is not None:
+                self._file.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+                self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def default_session_log_path():
+    """記録ファイルの既定の保存先を返す"""
+    return os.path.join(get_config_dir(), "sessions", time.strftime("session-%Y%m%d-%H%M%S.jsonl"))
+
+
+def load_session_log(path):
+    """記録ファイルを読み込んで (ヘッダー, イベントのリスト) を返す"""
+    header = {}
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event.get("type") == "session":
+                header = event
+            else:
+                events.append(event)
+    return header, events
+
+
+def summarize_durations(values):
+    """処理時間のリストから件数・平均・パーセンタイルを求める"""
+    if not values:
+        return {"n": 0}
+    data = np.asarray(values, dtype=np.float64)
+    return {
+        "n": int(data.size),
+        "mean": float(data.mean()),
+        "p50": float(np.percentile(data, 50)),
+        "p90": float(np.percentile(data, 90)),
+        "p99": float(np.percentile(data, 99)),
+        "max": float(data.max()),
+    }
+
+
+def summarize_session(events):
+    """記録したイベントから遅延の分布を集計する"""
+    previews = [e for e in events if e["type"] == "preview" and e.get("status") == "ok"]
+    applies = [e for e in events if e["type"] == "apply" and e.get("status") == "ok"]
+    # 入力からプレビューの表示完了までの時間（直前の入力から数える）
+    input_latency = []
+    last_input = None
+    for event in events:
+        if event["type"] == "input":
+            last_input = event["t"]
+        elif event["type"] == "preview" and event.get("status") == "ok" and last_input is not None:
+            input_latency.append(event["t"] - last_input)
+            last_input = None
+    return {
+        "preview_compute": summarize_durations([e["compute"] for e in previews]),
+        "preview_transport": summarize_durations([e["transport"] for e in previews]),
+        "preview_total": summarize_durations([e["compute"] + e["transport"] for e in previews]),
+        "input_to_preview": summarize_durations(input_latency),
+        "lock_hold": summarize_durations([e["hold"] for e in events if e["type"] == "lock"]),
+        "lock_wait": summarize_durations([e["wait"] for e in events if e["type"] == "lock"]),
+        "apply_compute": summarize_durations([e["compute"] for e in applies]),
+        "apply_transport": summarize_durations([e["transport"] for e in applies]),
+        "schedule": dict(Counter(e["decision"] for e in events if e["type"] == "schedule")),
+    }
+
+
+def format_summary(summary):
+    """集計結果を表示用の文字列にする"""
+    lines = []
+    for name, stats in summary.items():
+        if name == "schedule":
+            lines.append(f"{name:18s} " + ", ".join(f"{k}={v}" for k, v in sorted(stats.items())))
+        elif stats["n"] == 0:
+            lines.append(f"{name:18s} n=0")
+        else:
+            lines.append(f"{name:18s} n={stats['n']:<4d} " + " ".join(
+                f"{key}={stats[key] * 1000:8.1f}ms" for key in ("mean", "p50", "p90", "p99", "max")))
+    return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# シーケンスの一括処理（読み込み・計算・書き込みのパイプライン）
+# ---------------------------------------------------------------------------
+
+BATCH_PREFIX = "usm_"
+BATCH_PREFETCH = 4
+BATCH_POLL_INTERVAL = 0.1
+FITS_EXTENSIONS = (".fit", ".fits", ".fts")
+# 書き出し時に astropy が配列の型から設定し直すキーワード
+FITS_SCALING_KEYWORDS = ("BZERO", "BSCALE")
+
+
+def lazy_fits():
+    """astropy.io.fits を初回使用時に読み込む"""
+    ensure_installed_cached("astropy")
+    return importlib.import_module("astropy.io.fits")
+
+
+def read_frame(path, out=None):
+    """FITS または .npy のフレームを読み込んで (データ, ヘッダー) を返す
+    
+    out に同じ形・型の配列を渡すと、その配列に読み込んで使い回す。
+    """
+    if path.lower().endswith(".npy"):
+        data, header = np.load(path, mmap_mode="r"), None
+    else:
+        with lazy_fits().open(path, memmap=False) as hdul:
+            hdu = next(h for h in hdul if h.data is not None)
+            data, header = hdu.data, hdu.header.copy()
+    if out is not None and out.shape == data.shape and out.dtype == data.dtype:
+        np.copyto(out, data)
+        return out, header
+    return np.array(data), header
+
+
+def write_frame(path, data, header=None):
+    """フレームを FITS または .npy として書き出す（一時ファイルに書いてから置き換える）"""
+    tmp_path = path + ".tmp"
+    if path.lower().endswith(".npy"):
+        with open(tmp_path, "wb") as f:
+            np.save(f, data)
+    else:
+        fits = lazy_fits()
+        header = header.copy() if header is not None else fits.Header()
+        for keyword in FITS_SCALING_KEYWORDS:
+            header.remove(keyword, ignore_missing=True)
+        fits.PrimaryHDU(data, header).writeto(tmp_path, overwrite=True, output_verify="silentfix")
+    os.replace(tmp_path, path)
+
+
+def expand_frame_paths(patterns):
+    """ファイル名とワイルドカードを展開し、処理できるフレームのパスを名前順に返す"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(p for p in matches if p.lower().endswith(FITS_EXTENSIONS + (".npy",)))
+    return paths
+
+
+class Frame:
+    """パイプラインを流れる1フレーム分の情報"""
+    
+    def __init__(self, index, path, data, header):
+        self.index = index
+        self.path = path
+        self.data = data
+        self.header = header
+        self.output = None
+
+
+class FramePool:
+    """同じ形・型のフレーム用配列を使い回す
+    
+    空きがない場合は返却されるまで待つので、パイプライン全体のメモリ使用量の上限にもなる。
+    形・型の違うフレームには新しく確保した配列を使う（返却時に破棄する）。
+    """
+    
+    def __init__(self, shape, dtype, count):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.allocated = count
+        self._free = queue.Queue()
+        for _ in range(count):
+            self._free.put(np.empty(self.shape, dtype=self.dtype))
+    
+    def acquire(self, stop, shape=None, dtype=None):
+        if shape is not None and (tuple(shape) != self.shape or np.dtype(dtype) != self.dtype):
+            self.allocated += 1
+            return np.empty(shape, dtype=dtype)
+        while not stop.is_set():
+            try:
+                return self._free.get(timeout=BATCH_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        raise TaskCancelled()
+    
+    def release(self, buffer):
+        if buffer is not None and buffer.shape == self.shape and buffer.dtype == self.dtype:
+            self._free.put(buffer)
+
+
+class StageStats:
+    """パイプラインの各段の処理時間（待ち時間を除く）を集計する"""
+    
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.busy += time.perf_counter() - start
+                self.items += 1
+    
+    def utilization(self, wall):
+        """稼働率（全ワーカーの処理時間の合計 / (経過時間 × ワーカー数)）"""
+        return self.busy / (wall * self.workers) if wall > 0 else 0.0
+
+
+def queue_put(target, item, stop):
+    """キューが空くまで待って追加する（中止された場合は TaskCancelled を送出する）"""
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=BATCH_POLL_INTERVAL)
+            return
+        except queue.Full:
+            pass
+    raise TaskCancelled()
+
+
+def queue_get(source, stop):
+    """キューから取り出す（中止された場合は TaskCancelled を送出する）"""
+    while not stop.is_set():
+        try:
+            return source.get(timeout=BATCH_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    raise TaskCancelled()
+
+
+def batch_output_path(path, output_dir, prefix=BATCH_PREFIX):
+    """出力ファイルのパス（Sirilのシーケンスと同じく接頭辞を付け、番号はそのまま残す）"""
+    return os.path.join(output_dir, prefix + os.path.basename(path))
+
+
+def run_batch(paths, output_dir, layers, threshold=0.0, protect_level=None, blur=None,
+              prefetch=BATCH_PREFETCH, workers=None, prefix=BATCH_PREFIX, progress=None, stop=None):
+    """複数のフレームに同じパラメータのアンシャープマスクをかけて書き出す
+    
+    読み込みスレッドが prefetch 枚先までフレームを読み込み、計算スレッド（workers 個）が処理し、
+    書き込みスレッドが結果を書き出す。各段の間は上限付きのキューでつなぎ、フレーム用の配列は
+    使い回す。戻り値は各段の稼働率などをまとめた辞書。
+    """
+    if not paths:
+        raise ValueError("処理するフレームがありません")
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or max(1, min(os.cpu_count() or 1, 4))
+    stop = stop or threading.Event()
+    if blur is None:
+        blur = BlurEngine().blur_local
+    
+    # 最初のフレームの形・型で配列を確保する
+    first, first_header = read_frame(paths[0])
+    inputs = FramePool(first.shape, first.dtype, prefetch + workers)
+    outputs = FramePool(first.shape, first.dtype, prefetch + workers)
+    read_queue = queue.Queue(maxsize=prefetch)
+    write_queue = queue.Queue(maxsize=prefetch)
+    stats = {name: StageStats(name, count) for name, count in
+             (("read", 1), ("compute", workers), ("write", 1))}
+    errors = []
+    written = []
+    
+    def stage(func):
+        def run():
+            try:
+                func()
+            except TaskCancelled:
+                pass
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+        return run
+    
+    def reader():
+        try:
+            for index, path in enumerate(paths):
+                if index == 0:
+                    buffer = inputs.acquire(stop)
+                    np.copyto(buffer, first)
+                    data, header = buffer, first_header
+                else:
+                    buffer = inputs.acquire(stop)
+                    with stats["read"].measure():
+                        data, header = read_frame(path, buffer)
+                    if data is not buffer:
+                        inputs.release(buffer)
+                queue_put(read_queue, Frame(index, path, data, header), stop)
+        finally:
+            for _ in range(workers):
+                with contextlib.suppress(TaskCancelled):
+                    queue_put(read_queue, None, stop)
+    
+    def computer():
+        try:
+            while True:
+                frame = queue_get(read_queue, stop)
+                if frame is None:
+                    return
+                out = outputs.acquire(stop, frame.data.shape, frame.data.dtype)
+                with stats["compute"].measure():
+                    weight = None
+                    if protect_level is not None:
+                        weight = compute_protection_weight(frame.data, protect_level)
+                    frame.output = unsharp_streamed(frame.data, layers, blur, out, None, None,
+                                                    threshold, weight)
+                inputs.release(frame.data)
+                frame.data = None
+                queue_put(write_queue, frame, stop)
+        finally:
+            with contextlib.suppress(TaskCancelled):
+                queue_put(write_queue, None, stop)
+    
+    def writer():
+        remaining = workers
+        while remaining:
+            frame = queue_get(write_queue, stop)
+            if frame is None:
+                remaining -= 1
+                continue
+            output_path = batch_output_path(frame.path, output_dir, prefix)
+            with stats["write"].measure():
+                write_frame(output_path, frame.output, frame.header)
+            outputs.release(frame.output)
+            written.append(output_path)
+            if progress is not None:
+                progress(len(written), len(paths))
+    
+    start = time.perf_counter()
+    threads = [threading.Thread(target=stage(reader), name="batch-read")]
+    threads += [threading.Thread(target=stage(computer), name=f"batch-compute-{i}") for i in range(workers)]
+    threads.append(threading.Thread(target=stage(writer), name="batch-write"))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    
+    if errors:
+        raise errors[0]
+    if len(written) < len(paths):
+        raise TaskCancelled()
+    stages = {name: {"busy": stat.busy, "items": stat.items, "workers": stat.workers,
+                     "utilization": stat.utilization(wall)} for name, stat in stats.items()}
+    return {
+        "frames": len(written),
+        "wall": wall,
+        "fps": len(written) / wall if wall > 0 else 0.0,
+        "stages": stages,
+        # 稼働率が最も高い段が全体の速度を決めている
+        "bound": max(stages, key=lambda name: stages[name]["utilization"]),
+        "buffers": inputs.allocated + outputs.allocated,
+        "outputs": written,
+    }
+
+
+def format_batch_report(report):
+    """一括処理の結果を表示用の文字列にする"""
+    lines = [f"{report['frames']} フレーム, {report['wall']:.2f} 秒 ({report['fps']:.2f} フレーム/秒), "
+             f"配列 {report['buffers']} 個"]
+    for name, stage in report["stages"].items():
+        lines.append(f"  {name:8s} 稼働率 {stage['utilization'] * 100:5.1f}%  "
+                     f"処理時間 {stage['busy']:.2f} 秒 (ワーカー {stage['workers']})")
+    bound = {"read": "読み込み", "compute": "計算", "write": "書き込み"}[report["bound"]]
+    lines.append(f"  律速段階: {bound}")
+    return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# メモリに収まらない画像の処理（FITSファイルをメモリマップで少しずつ読み書きする）
+# ---------------------------------------------------------------------------
+
+# 1回に読み込む行数の目安（元の型のバイト数）。計算は読み込んだ範囲の中でさらに短冊に分けて行う
+PROCESS_CHUNK_BYTES = 64 * 1024 * 1024
+FITS_BLOCK_SIZE = 2880
+
+
+class FITSImageFile:
+    """FITSファイルの画素データのうち、必要な行だけをメモリマップで読み書きする
+    
+    Sirilが保存する形式（16bit: BITPIX=16, BZERO=32768 / 32bit: BITPIX=-32）に対応する。
+    メモリマップは行の範囲ごとに作って使い終わったら閉じるので、ファイルが大きくても
+    メモリ使用量は読み書きする範囲の分だけになり、ファイルは先頭から順に読み書きされる。
+    """
+    
+    def __init__(self, path, header, offset):
+        self.path = path
+        self.header = header
+        self.offset = offset
+        bitpix = header["BITPIX"]
+        bzero, bscale = header.get("BZERO", 0), header.get("BSCALE", 1)
+        if bitpix == 16 and bzero == 32768 and bscale == 1:
+            self.raw_dtype, self.dtype = np.dtype(">i2"), np.dtype(np.uint16)
+        elif bitpix == -32 and bzero == 0 and bscale == 1:
+            self.raw_dtype, self.dtype = np.dtype(">f4"), np.dtype(np.float32)
+        else:
+            raise ValueError(f"未対応のFITS形式です (BITPIX={bitpix}, BZERO={bzero}, BSCALE={bscale})")
+        naxis = header["NAXIS"]
+        if naxis not in (2, 3):
+            raise ValueError(f"未対応の次元数です (NAXIS={naxis})")
+        # FITSの軸の順序は (幅, 高さ, チャンネル) なので逆にする
+        self.shape = tuple(header[f"NAXIS{axis}"] for axis in range(naxis, 0, -1))
+        self.channels = self.shape[0] if naxis == 3 else 1
+        self.height, self.width = self.shape[-2:]
+    
+    @classmethod
+    def open(cls, path):
+        """既存のFITSファイルを開く（最初の画像HDUを使う）"""
+        fits = lazy_fits()
+        with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+            for index, hdu in enumerate(hdul):
+                if hdu.header.get("NAXIS", 0) >= 2:
+                    return cls(path, hdu.header.copy(), hdul.fileinfo(index)["datLoc"])
+        raise ValueError(f"画像が含まれていません: {path}")
+    
+    @classmethod
+    def create(cls, path, header):
+        """header と同じ形・型の画像を書き込むためのFITSファイルを作る（画素データは0）"""
+        header = header.copy()
+        for keyword in ("EXTEND", "PCOUNT", "GCOUNT", "XTENSION"):
+            header.remove(keyword, ignore_missing=True)
+        header.set("SIMPLE", True, before=0)
+        header_bytes = header.tostring().encode("ascii")
+        image = cls(path, header, len(header_bytes))
+        data_bytes = int(np.prod(image.shape)) * image.raw_dtype.itemsize
+        padded = -(-data_bytes // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE
+        with open(path, "wb") as f:
+            f.write(header_bytes)
+            # ファイルの大きさだけを確保する（多くのファイルシステムでは実際の書き込みは発生しない）
+            f.truncate(len(header_bytes) + padded)
+        return image
+    
+    def _map(self, channel, top, bottom, mode):
+        offset = self.offset + (channel * self.height + top) * self.width * self.raw_dtype.itemsize
+        return np.memmap(self.path, dtype=self.raw_dtype, mode=mode, offset=offset,
+                         shape=(bottom - top, self.width))
+    
+    def read_rows(self, top, bottom):
+        """top〜bottom行目を (チャンネル, 行, 幅) または (行, 幅) の配列として読み込む"""
+        out = np.empty((self.channels, bottom - top, self.width), dtype=self.dtype)
+        for channel in range(self.channels):
+            raw = self._map(channel, top, bottom, "r")
+            if self.dtype == np.uint16:
+                # BZERO=32768 の符号付き16bitは、最上位ビットを反転すると符号なし16bitになる
+                np.bitwise_xor(raw.astype(np.int16).view(np.uint16), 0x8000, out=out[channel])
+            else:
+                out[channel] = raw
+            del raw
+        return out if len(self.shape) == 3 else out[0]
+    
+    def write_rows(self, top, data):
+        """top行目から data を書き込む"""
+        data = data.reshape(self.channels, -1, self.width)
+        for channel in range(self.channels):
+            raw = self._map(channel, top, top + data.shape[1], "r+")
+            if self.dtype == np.uint16:
+                raw[:] = np.bitwise_xor(data[channel], 0x8000).view(np.int16)
+            else:
+                raw[:] = data[channel]
+            raw.flush()
+            del raw
+
+
+def process_rows_for(image, halo, chunk_bytes=PROCESS_CHUNK_BYTES):
+    """1回に読み込む行数（読み込む範囲に対して余白の重複が多くなりすぎないようにする）"""
+    row_bytes = image.channels * image.width * image.dtype.itemsize
+    return min(max(chunk_bytes // max(row_bytes, 1), 6 * halo, STREAM_MIN_ROWS), image.height)
+
+
+def unsharp_fits_file(input_path, output_path, layers, blur, threshold=0.0,
+                      chunk_bytes=PROCESS_CHUNK_BYTES, progress=None):
+    """FITSファイルを読み込み範囲ごとに処理し、別のFITSファイルに書き出す
+    
+    各範囲はブラーの余白を付けて読み込み、unsharp_streamed() で処理して余白を除いた部分を
+    書き出すので、結果は画像全体を一度に処理した場合と一致する。メモリ使用量は範囲の大きさ
+    (chunk_bytes) で決まり、画像の大きさにはよらない。保護マスクは画像全体の計算が必要なため
+    使えない。戻り値は {"shape", "dtype", "chunks", "rows", "seconds"} の辞書。
+    """
+    source = FITSImageFile.open(input_path)
+    halo = scale_space_halo([sigma for sigma, _ in layers])
+    rows = process_rows_for(source, halo, chunk_bytes)
+    tmp_path = output_path + ".tmp"
+    target = FITSImageFile.create(tmp_path, source.header)
+    start = time.perf_counter()
+    chunks = 0
+    try:
+        for top in range(0, source.height, rows):
+            bottom = min(top + rows, source.height)
+            src_top = max(top - halo, 0)
+            src_bottom = min(bottom + halo, source.height)
+            region = source.read_rows(src_top, src_bottom)
+            unsharp = unsharp_streamed(region, layers, blur, None, None, None, threshold)
+            target.write_rows(top, unsharp[..., top - src_top:bottom - src_top, :])
+            del region, unsharp
+            chunks += 1
+            if progress is not None:
+                progress(bottom, source.height)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    return {"shape": source.shape, "dtype": str(source.dtype), "chunks": chunks, "rows": rows,
+            "seconds": time.perf_counter() - start}
+
+
+# ---------------------------------------------------------------------------
+# プレビューの転送方法（v1〜v3の方式の比較）
+# ---------------------------------------------------------------------------
+
+# 対話中のプレビューは常に UnsharpMaskGUI.update_preview() のNumPyでの計算（v3）を使う。
+# ここの方法は benchmark で比較して表示するためだけのもの
+BENCHMARK_SIZES = (512, 1024, 2048)
+BENCHMARK_LAYERS = ((1.5, 0.8),)
+
+PREVIEW_STRATEGIES = {}
+
+
+def register_preview_strategy(cls):
+    """プレビューの転送方法を登録するデコレータ"""
+    PREVIEW_STRATEGIES[cls.name] = cls
+    return cls
+
+
+class PreviewStrategy:
+    """元画像からプレビューを作ってSirilに表示させる方法"""
+    
+    name = ""
+    label = ""
+    
+    def __init__(self, siril, blur=None):
+        self.siril = siril
+        self.session = siril_session(siril)
+        self.blur = blur or BlurEngine().blur_local
+    
+    def prepare(self, original):
+        """元画像を受け取ったときの準備"""
+    
+    def preview(self, original, layers):
+        """プレビューを表示し、{"compute": 秒, "transport": 秒} を返す"""
+        raise NotImplementedError
+    
+    def close(self):
+        """後片付け"""
+
+
+@register_preview_strategy
+class NumpyPreviewStrategy(PreviewStrategy):
+    """NumPyで計算して画素データを送る（v3）"""
+    
+    name = "numpy"
+    label = "NumPyで計算して転送 (v3)"
+    
+    def prepare(self, original):
+        # 出力バッファはプレビューごとに確保せず使い回す（Sirilには送信時にコピーされる）
+        self.output = np.empty_like(original)
+    
+    def preview(self, original, layers):
+        start = time.perf_counter()
+        unsharp = unsharp_streamed(original, layers, self.blur, self.output)
+        computed = time.perf_counter()
+        self.session.push(unsharp, "preview", delays=SESSION_PREVIEW_RETRY_DELAYS)
+        return {"compute": computed - start, "transport": time.perf_counter() - computed}
+
+
+@register_preview_strategy
+class CommandPreviewStrategy(PreviewStrategy):
+    """元画像を送り戻してから unsharp コマンドを実行する（v1 / v2.1）"""
+    
+    name = "command"
+    label = "unsharpコマンド (v1 / v2.1)"
+    # v3でやめた方法（処理中の拡大縮小でSirilが落ちる原因になり、確定時のNumPyの結果とも
+    # 一致しない）。LocalSirilInterface では Siril のコマンドの速さも測れない
+    
+    def preview(self, original, layers):
+        (sigma, multi), = layers
+        start = time.perf_counter()
+        self.session.push(original, "preview", delays=SESSION_PREVIEW_RETRY_DELAYS)
+        restored = time.perf_counter()
+        self.session.command("unsharp", str(sigma), str(multi), delays=SESSION_PREVIEW_RETRY_DELAYS)
+        return {"compute": time.perf_counter() - restored, "transport": restored - start}
+
+
+@register_preview_strategy
+class TempFilePreviewStrategy(PreviewStrategy):
+    """元画像を一時ファイルに保存し、毎回読み込み直してから unsharp コマンドを実行する（v2）"""
+    
+    name = "tempfile"
+    label = "一時ファイル経由 (v2)"
+    # 読み込んだ一時ファイルがSirilで開いている画像になってしまうため、v3でやめた方法
+    
+    def __init__(self, siril, blur=None):
+        super().__init__(siril, blur)
+        self.directory = None
+        self.original_file = None
+    
+    def prepare(self, original):
+        self.directory = tempfile.mkdtemp(prefix="siril_unsharp_")
+        self.original_file = os.path.join(self.directory, "original.fit")
+        self.session.command("save", self.original_file)
+    
+    def preview(self, original, layers):
+        (sigma, multi), = layers
+        start = time.perf_counter()
+        self.session.command("load", self.original_file)
+        loaded = time.perf_counter()
+        self.session.command("unsharp", str(sigma), str(multi))
+        return {"compute": time.perf_counter() - loaded, "transport": loaded - start}
+    
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def benchmark_preview_strategy(name, image, layers=BENCHMARK_LAYERS, repeats=3):
+    """LocalSirilInterface を相手に1つの転送方法を計測する
+    
+    戻り値はプレビュー1回あたりの遅延（最小値）・受け渡したバイト数・ピークメモリと、
+    v3の計算結果との最大差。
+    """
+    siril = LocalSirilInterface(image)
+    strategy = PREVIEW_STRATEGIES[name](siril, BlurEngine(None, image.dtype).get_backend("scipy").blur)
+    try:
+        strategy.prepare(image)
+        strategy.preview(image, layers)  # ウォームアップを兼ねる
+        reference = unsharp_streamed(image, layers, strategy.blur)
+        error = int(np.max(np.abs(siril.image.astype(np.float64) - reference)) /
+                    dtype_max(image.dtype) * 65535)
+        
+        siril.reset_counters()
+        latency = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            strategy.preview(image, layers)
+            elapsed = time.perf_counter() - start
+            latency = elapsed if latency is None else min(elapsed, latency)
+        bytes_moved = siril.bytes_moved() // repeats
+        
+        # メモリの計測は時間の計測と分けて行う（tracemalloc の負荷が時間に影響するため）
+        tracemalloc.start()
+        try:
+            strategy.preview(image, layers)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        strategy.close()
+    return {"latency": latency, "bytes": bytes_moved, "peak": peak, "error": error}
+
+
+def benchmark_preview_strategies(sizes=BENCHMARK_SIZES, channels=3, dtype=np.uint16,
+                                 layers=BENCHMARK_LAYERS, repeats=3, progress=None):
+    """画像サイズごとに全ての転送方法を計測する（表示用。GUIの動作は変えない）
+    
+    戻り値は サイズ -> {方法 -> 計測結果} の辞書。
+    """
+    results = {}
+    for size in sizes:
+        shape = (channels, size, size) if channels > 1 else (size, size)
+        image = make_test_image(shape, dtype)
+        entry = {}
+        for name in PREVIEW_STRATEGIES:
+            if progress is not None:
+                progress(f"{size}x{size} {name}")
+            entry[name] = benchmark_preview_strategy(name, image, layers, repeats)
+        results[size] = entry
+    return results
+
+
+def format_benchmark(results):
+    """計測結果を表示用の文字列にする"""
+    lines = [f"{'size':>10s} {'strategy':10s} {'latency':>10s} {'moved':>10s} {'peak':>10s} {'diff':>5s}"]
+    for size, entry in results.items():
+        for name in PREVIEW_STRATEGIES:
+            stats = entry[name]
+            lines.append(f"{size:>4d}x{size:<5d} {name:10s} {stats['latency'] * 1000:8.1f}ms "
+                         f"{stats['bytes'] / 2**20:8.1f}MB {stats['peak'] / 2**20:8.1f}MB "
+                         f"{stats['error']:5d}")
+    lines.append("diff: v3の結果との最大差 (16bit換算) / 対話中のプレビューは常に numpy (v3) を使う")
+    return "\n".join(lines)
+
+
+BUFFER_OPERATIONS = ("preview", "cached", "reset", "apply")
+
+
+def buffer_flows(image, layers):
+    """benchmark_buffers で比べる方法を {方法: {"siril", "operations", "allocations", "settle", "close"}} で返す
+    
+    "v3" は元のv3の受け渡し（プレビュー・確定のたびに画像全体を float32 に変換し、get_image() で
+    受け取った配列に結果を書き込んで送る。リセットは元画像をコピーしてから送り、確定後は画像を
+    読み直す）。"gui" は画面なしで起動した UnsharpMaskGUI の update_preview()・reset_image()・
+    apply_changes() をそのまま呼ぶ。使うのは layers の先頭のレイヤーで、プレビューは呼ぶたびに
+    multi を 0.01 ずつ変えて新しく計算させ、"cached" は直前のプレビューをもう一度表示する。
+    settle() は操作の後に呼び、時間の計測に含めない（結果のキャッシュの圧縮を待つ）。
+    """
+    sigma, multi = layers[0]
+    
+    def preview_multi(step):
+        return float(f"{multi + 0.01 * step:.2f}")
+    
+    legacy_siril = LocalSirilInterface(image)
+    legacy = {"original": image.copy(), "step": 0}
+    
+    def legacy_push(data):
+        with legacy_siril.image_lock():
+            fit = legacy_siril.get_image()
+            fit.data[:] = data
+            legacy_siril.set_image_pixeldata(fit.data)
+    
+    def legacy_preview(step=1):
+        legacy["step"] += step
+        legacy_push(reference_unsharp(legacy["original"], [(sigma, preview_multi(legacy["step"]))]))
+    
+    def legacy_apply():
+        with legacy_siril.image_lock():
+            legacy_siril.undo_save_state("benchmark")
+            fit = legacy_siril.get_image()
+            fit.data[:] = reference_unsharp(legacy["original"], [(sigma, multi)])
+            legacy_siril.set_image_pixeldata(fit.data)
+        with legacy_siril.image_lock():
+            legacy["original"] = legacy_siril.get_image().data.copy()
+    
+    app, window = start_offscreen_gui(image)
+    # v3と結果を比べるため、gaussian_filter と同じ計算のバックエンドを使う
+    window.blur_engine.forced_backend = "scipy"
+    current = {"step": 0}
+    
+    def show(value):
+        window.set_parameters(sigma, value)
+        window.preview_update_timer.stop()
+        window.update_preview()
+    
+    def preview(step=1):
+        current["step"] += step
+        show(preview_multi(current["step"]))
+    
+    def apply():
+        window.set_parameters(sigma, multi)
+        window.preview_update_timer.stop()
+        window.apply_changes()
+        process_events_until(app, lambda: window.apply_task is None and not window.tasks)
+    
+    return {
+        "v3": {
+            "siril": legacy_siril,
+            "operations": {
+                "preview": legacy_preview,
+                "cached": lambda: legacy_preview(0),
+                "reset": lambda: legacy_push(legacy["original"].copy()),
+                "apply": legacy_apply,
+            },
+            "allocations": lambda: None,
+            "settle": lambda: None,
+            "close": lambda: None,
+        },
+        "gui": {
+            "siril": window.siril,
+            "operations": {
+                "preview": preview,
+                "cached": lambda: preview(0),
+                "reset": window.reset_image,
+                "apply": apply,
+            },
+            "allocations": lambda: window.buffers.allocations,
+            # 結果のキャッシュが圧縮した配列を出力バッファに戻すまで待つ
+            "settle": window.result_cache.flush,
+            "close": window.close,
+        },
+    }
+
+
+def benchmark_buffers(image, layers=BENCHMARK_LAYERS, repeats=3):
+    """プレビュー・リセット・確定で受け渡し・確保するデータ量を、元のv3と現在の方法で比べる
+    
+    現在の方法はGUIの処理そのものを計測する（buffer_flows() を参照）。戻り値は 方法 -> 操作 -> 計測結果
+    の辞書。received・sent（Sirilとの受け渡し）と peak（操作中に新しく確保したメモリの最大）は画像1枚分
+    を1とした量で、allocations は新しく確保した画像サイズの配列の数（GUIのみ）、error は2つの方法の
+    Sirilの画像の最大差 (16bit換算)。
+    """
+    results = {}
+    images = {}
+    flows = buffer_flows(image, layers)
+    try:
+        for flow, entry in flows.items():
+            siril, allocations, settle = entry["siril"], entry["allocations"], entry["settle"]
+            results[flow] = {}
+            for name in BUFFER_OPERATIONS:
+                func = entry["operations"][name]
+                # ウォームアップ（出力バッファの作成と、結果のキャッシュが一杯になるまでを含む）
+                for _ in range(RESULT_CACHE_RAW_ENTRIES + 1):
+                    func()
+                    settle()
+                siril.reset_counters()
+                before = allocations()
+                latency = None
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    func()
+                    elapsed = time.perf_counter() - start
+                    latency = elapsed if latency is None else min(elapsed, latency)
+                    settle()
+                stats = {
+                    "latency": latency,
+                    "received": siril.bytes_received / image.nbytes / repeats,
+                    "sent": siril.bytes_sent / image.nbytes / repeats,
+                    "allocations": None if before is None else (allocations() - before) / repeats,
+                }
+                # メモリの計測は時間の計測と分けて行う
+                tracemalloc.start()
+                try:
+                    func()
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                settle()
+                stats["peak"] = peak / image.nbytes
+                results[flow][name] = stats
+                images[flow, name] = siril.image.copy()
+    finally:
+        for entry in flows.values():
+            entry["close"]()
+    for flow in results:
+        for name in BUFFER_OPERATIONS:
+            results[flow][name]["error"] = difference_16bit(images[flow, name], images["v3", name])
+    return results
+
+
+def format_buffer_benchmark(results_by_size):
+    """benchmark_buffers の結果を表示用の文字列にする"""
+    lines = [f"{'size':>10s} {'operation':10s} {'flow':8s} {'latency':>10s} {'received':>9s} {'sent':>6s} "
+             f"{'peak':>6s} {'alloc':>6s} {'diff':>5s}"]
+    for size, results in results_by_size.items():
+        for name in BUFFER_OPERATIONS:
+            for flow, entry in results.items():
+                stats = entry[name]
+                allocations = "-" if stats["allocations"] is None else f"{stats['allocations']:.1f}"
+                lines.append(f"{size:>4d}x{size:<5d} {name:10s} {flow:8s} {stats['latency'] * 1000:8.1f}ms "
+                             f"{stats['received']:9.1f} {stats['sent']:6.1f} {stats['peak']:6.1f} "
+                             f"{allocations:>6s} {stats['error']:5.0f}")
+    lines.append("received/sent/peak: 画像1枚分を1とした量 / alloc: 新しく確保した画像サイズの配列の数 "
+                 "/ diff: v3との最大差 (16bit換算)")
+    return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# バックグラウンド処理
+# ---------------------------------------------------------------------------
+
+class TaskCancelled(Exception):
+    """バックグラウンド処理がキャンセルされた"""
+
+
+class BackgroundTask(QThread):
+    """重い処理を別スレッドで実行する（進捗通知・キャンセル対応）
+    
+    func(task) の形で呼び出す。func は task.report() で進捗を通知し、
+    task.check_cancelled() でキャンセル要求を確認する。
+    """
+    # 進捗 (0.0〜1.0、負の値は進捗不明), メッセージ
+    progress = pyqtSignal(float, str)
+    # 途中結果（少しずつ表示したい結果）
+    partial = pyqtSignal(object)
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+    
+    def __init__(self, func, parent=None):
+        super().__init__(parent)
+        self.func = func
+        self._cancel_event = threading.Event()
+    
+    def cancel(self):
+        self._cancel_event.set()
+    
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+    
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise TaskCancelled()
+    
+    def report(self, fraction, message=""):
+        self.progress.emit(float(fraction), message)
+    
+    def publish(self, result):
+        self.partial.emit(result)
+    
+    def run(self):
+        try:
+            result = self.func(self)
+        except TaskCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(result)
+
+
+class ParameterGridDialog(QDialog):
+    """sigma×multiの組み合わせを縮小表示で並べて比較するダイアログ"""
+    
+    def __init__(self, gui):
+        super().__init__(gui)
+        self.gui = gui
+        self.task = None
+        self.cells = {}
+        self.sigmas = []
+        self.multis = []
+        self.display_levels = (0.0, 1.0)
+        
+        self.setWindowTitle("パラメータ比較")
+        self.resize(780, 640)
+        
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+        
+        # 比較する値と切り出し範囲
+        form = QGridLayout()
+        form.addWidget(QLabel("Sigma:"), 0, 0)
+        self.sigma_list_entry = QLineEdit("0.5, 1.0, 2.0, 4.0")
+        form.addWidget(self.sigma_list_entry, 0, 1, 1, 5)
+        
+        form.addWidget(QLabel("Multi:"), 1, 0)
+        self.multi_list_entry = QLineEdit("0.5, 1.0, 2.0, 3.0")
+        form.addWidget(self.multi_list_entry, 1, 1, 1, 5)
+        
+        height, width = gui.original_image_data.shape[-2:]
+        form.addWidget(QLabel("中心 X:"), 2, 0)
+        self.center_x_spin = QSpinBox()
+        self.center_x_spin.setRange(0, width - 1)
+        self.center_x_spin.setValue(width // 2)
+        form.addWidget(self.center_x_spin, 2, 1)
+        
+        form.addWidget(QLabel("中心 Y:"), 2, 2)
+        self.center_y_spin = QSpinBox()
+        self.center_y_spin.setRange(0, height - 1)
+        self.center_y_spin.setValue(height // 2)
+        form.addWidget(self.center_y_spin, 2, 3)
+        
+        form.addWidget(QLabel("サイズ:"), 2, 4)
+        self.crop_size_spin = QSpinBox()
+        self.crop_size_spin.setRange(32, 1024)
+        self.crop_size_spin.setValue(256)
+        form.addWidget(self.crop_size_spin, 2, 5)
+        layout.addLayout(form)
+        
+        button_layout = QHBoxLayout()
+        button_layout.addStretch()
+        self.render_button = QPushButton("描画")
+        self.render_button.clicked.connect(self.render)
+        button_layout.addWidget(self.render_button)
+        layout.addLayout(button_layout)
+        
+        # サムネイルの表示領域
+        self.grid_widget = QWidget()
+        self.grid_layout = QGridLayout()
+        self.grid_widget.setLayout(self.grid_layout)
+        scroll = QScrollArea()
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(self.grid_widget)
+        layout.addWidget(scroll)
+        
+        self.status_label = QLabel("サムネイルをクリックすると、その値をスライダーに設定します")
+        layout.addWidget(self.status_label)
+    
+    def render(self):
+        """グリッドを描画する"""
+        try:
+            sigmas = parse_float_list(self.sigma_list_entry.text())
+            multis = parse_float_list(self.multi_list_entry.text())
+        except ValueError:
+            self.status_label.setText("数値をカンマ区切りで入力してください")
+            return
+        if not sigmas or not multis:
+            self.status_label.setText("SigmaとMultiを1つ以上入力してください")
+            return
+        if len(sigmas) > GRID_MAX_VALUES or len(multis) > GRID_MAX_VALUES:
+            self.status_label.setText(f"SigmaとMultiはそれぞれ{GRID_MAX_VALUES}個までです")
+            return
+        if not all(0.1 <= v <= 10.0 for v in sigmas) or not all(0.0 <= v <= 5.0 for v in multis):
+            self.status_label.setText("Sigmaは0.1-10.0、Multiは0.0-5.0の範囲で入力してください")
+            return
+        try:
+            threshold, protect_level = self.gui.current_mask_options()
+        except ValueError as e:
+            self.status_label.setText(f"値の解析エラー: {e}")
+            return
+        
+        self.cancel_task()
+        self.sigmas, self.multis = sigmas, multis
+        
+        original = self.gui.original_image_data
+        size = self.crop_size_spin.value()
+        height, width = original.shape[-2:]
+        top = min(max(self.center_y_spin.value() - size // 2, 0), max(height - size, 0))
+        left = min(max(self.center_x_spin.value() - size // 2, 0), max(width - size, 0))
+        crop = (top, left, size)
+        # すべてのサムネイルを同じ階調で表示する（元画像の切り出し範囲で決める）
+        self.display_levels = display_range(original[..., top:top + size, left:left + size])
+        
+        self.build_grid()
+        total = len(sigmas) * len(multis)
+        start = time.perf_counter()
+        blur = self.gui.blur_engine.blur_local
+        
+        def compute(task):
+            weight = None
+            if protect_level is not None:
+                weight = self.gui.mask_cache.get(original, protect_level)
+            render_parameter_grid(original, crop, sigmas, multis, blur,
+                                  lambda row, column, data: task.publish((row, column, data)),
+                                  task.check_cancelled, threshold, weight)
+            return time.perf_counter() - start
+        
+        task = BackgroundTask(compute, self)
+        task.partial.connect(lambda result: self.on_cell_rendered(task, result))
+        task.succeeded.connect(lambda elapsed: self.status_label.setText(
+            f"{total}枚を{elapsed:.2f}秒で描画しました（ブラーの計算 {len(sigmas)}回）"))
+        task.failed.connect(lambda message: self.status_label.setText(f"描画エラー: {message}"))
+        self.task = task
+        self.status_label.setText("描画中...")
+        task.start()
+    
+    def build_grid(self):
+        """見出しと空のサムネイルを配置する"""
+        while self.grid_layout.count():
+            item = self.grid_layout.takeAt(0)
+            if item.widget() is not None:
+                item.widget().deleteLater()
+        self.cells = {}
+        
+        self.grid_layout.addWidget(QLabel("sigma \\ multi"), 0, 0)
+        for column, multi in enumerate(self.multis):
+            self.grid_layout.addWidget(QLabel(f"{multi:.2f}"), 0, column + 1, Qt.AlignmentFlag.AlignCenter)
+        for row, sigma in enumerate(self.sigmas):
+            self.grid_layout.addWidget(QLabel(f"{sigma:.2f}"), row + 1, 0)
+            for column, multi in enumerate(self.multis):
+                button = QToolButton()
+                button.setFixedSize(GRID_THUMBNAIL_SIZE + 8, GRID_THUMBNAIL_SIZE + 8)
+                button.setIconSize(QSize(GRID_THUMBNAIL_SIZE, GRID_THUMBNAIL_SIZE))
+                button.setText("...")
+                button.setToolTip(f"sigma={sigma:.2f}, multi={multi:.2f}")
+                button.clicked.connect(lambda checked=False, v=(sigma, multi): self.gui.set_parameters(*v))
+                self.grid_layout.addWidget(button, row + 1, column + 1)
+                self.cells[(row, column)] = button
+    
+    def on_cell_rendered(self, task, result):
+        """サムネイルが1枚計算できたとき"""
+        # 描画し直した後に届いた古い結果は捨てる
+        if task is not self.task:
+            return
+        row, column, data = result
+        pixmap = QPixmap.fromImage(to_qimage(data, *self.display_levels)).scaled(
+            GRID_THUMBNAIL_SIZE, GRID_THUMBNAIL_SIZE, Qt.AspectRatioMode.KeepAspectRatio,
+            Qt.TransformationMode.SmoothTransformation)
+        button = self.cells.get((row, column))
+        if button is not None:
+            button.setText("")
+            button.setIcon(QIcon(pixmap))
+    
+    def cancel_task(self):
+        """描画中の処理を中止する"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task.wait()
+            self.task = None
+    
+    def closeEvent(self, event):
+        self.cancel_task()
+        super().closeEvent(event)
 
 
 class UnsharpMaskGUI(QMainWindow):
     """Unsharp Mask GUI for Siril"""
     
-    def __init__(self):
+    # 記録する操作部品と、その値が変わったときのシグナル名
+    RECORDED_INPUTS = (
+        ("sigma_slider", "valueChanged"), ("sigma_entry", "textChanged"),
+        ("multi_slider", "valueChanged"), ("multi_entry", "textChanged"),
+        ("multiscale_checkbox", "toggled"), ("layers_entry", "textChanged"),
+        ("threshold_slider", "valueChanged"), ("threshold_entry", "textChanged"),
+        ("protect_checkbox", "toggled"), ("protect_entry", "textChanged"),
+        ("backend_combo", "currentIndexChanged"),
+        ("reset_button", "clicked"), ("apply_button", "clicked"),
+    )
+    
+    def __init__(self, siril=None, recorder=None):
         super().__init__()
         
-        # Initialize Siril connection
-        self.siril = s.SirilInterface()
+        # siril を指定しない場合は実際のSirilに接続する（再生時は LocalSirilInterface を渡す）
+        self.siril = siril if siril is not None else s.SirilInterface()
+        self.session = siril_session(self.siril)
+        self.session.listener = lambda label, wait, hold, retries: self.record(
+            "lock", label=label, wait=wait, hold=hold, retries=retries)
+        self.recorder = recorder
+        
+        # Initialize variables
+        self.original_image_data = None
+        self.buffers = None
+        self.preview_update_timer = QTimer()
+        self.preview_update_timer.setSingleShot(True)
+        self.preview_update_timer.timeout.connect(self.update_preview)
+        self.is_updating = False
+        self.blur_engine = BlurEngine(self.siril)
+        self.tasks = []
+        self.apply_task = None
+        # 確定を途中でやめたときにSirilの画像を元に戻す処理
+        self.apply_restore = None
+        self.mask_cache = ProtectionMaskCache()
+        self.result_cache = ResultCache(release=self.release_buffer, pooled=self.pooled_buffer_bytes)
+        self.history = []
+        self.first_paint_time = None
         
+        # Create GUI（Sirilへの接続と元画像の取得はウィンドウの表示後に行う）
+        self.create_gui()
+        self.connect_recorder()
+        self.set_controls_enabled(False)
+    
+    def start_session(self):
+        """Sirilに接続して元画像の読み込みを開始する（ウィンドウ表示後に呼ぶ）"""
+        # Initialize Siril connection
         try:
             self.siril.connect()
             self.siril.log("Unsharp Mask GUI: 接続成功")
         except SirilConnectionError as e:
             QMessageBox.critical(None, "接続エラー", f"Sirilへの接続に失敗しました: {e}")
-            sys.exit(1)
+            QApplication.exit(1)
+            return
         
         # Check if an image is loaded
         if not self.siril.is_image_loaded():
             self.siril.error_messagebox("画像が読み込まれていません。")
-            sys.exit(1)
+            QApplication.exit(1)
+            return
         
         # Check Siril version (unsharp command has been available since early versions)
         try:
             self.siril.cmd("requires", "1.4.0")
         except s.CommandError:
             self.siril.error_messagebox("このスクリプトにはSiril 1.4.0以降が必要です。")
-            sys.exit(1)
-        
-        # Initialize variables
-        self.original_image_data = None
-        self.preview_update_timer = QTimer()
-        self.preview_update_timer.setSingleShot(True)
-        self.preview_update_timer.timeout.connect(self.update_preview)
-        self.is_updating = False
+            QApplication.exit(1)
+            return
         
         # Load and save original image
         self.load_original_image()
-        
-        # Create GUI
-        self.create_gui()
+    
+    def run_task(self, func, on_success, on_failure=None, on_cancel=None, show_progress=True):
+        """func をバックグラウンドで実行する"""
+        task = BackgroundTask(func, self)
+        task.succeeded.connect(on_success)
+        if on_failure is not None:
+            task.failed.connect(on_failure)
+        if on_cancel is not None:
+            task.cancelled.connect(on_cancel)
+        if show_progress:
+            task.progress.connect(self.on_task_progress)
+            self.progress_bar.setRange(0, 0)
+            self.progress_bar.show()
+        task.finished.connect(lambda: self.on_task_finished(task, show_progress))
+        self.tasks.append(task)
+        task.start()
+        return task
+    
+    def on_task_progress(self, fraction, message):
+        """バックグラウンド処理の進捗を表示"""
+        if fraction < 0:
+            # 進捗不明（ビジー表示）
+            self.progress_bar.setRange(0, 0)
+        else:
+            self.progress_bar.setRange(0, 1000)
+            self.progress_bar.setValue(int(fraction * 1000))
+        if message:
+            self.status_label.setText(message)
+    
+    def on_task_finished(self, task, show_progress):
+        """バックグラウンド処理の終了後の後始末"""
+        if task in self.tasks:
+            self.tasks.remove(task)
+        if show_progress:
+            self.progress_bar.hide()
+        task.deleteLater()
     
     def load_original_image(self):
-        """元画像を取得して保存"""
-        try:
-            with self.siril.image_lock():
-                fit = self.siril.get_image()
-                if fit is None or fit.data is None:
-                    self.siril.error_messagebox("画像データの取得に失敗しました。")
-                    sys.exit(1)
-                
-                # 元画像のデータをコピーして保存
-                self.original_image_data = fit.data.copy()
-                self.siril.log("元画像を保存しました")
-        except Exception as e:
-            self.siril.error_messagebox(f"画像の読み込みエラー: {e}")
-            sys.exit(1)
+        """元画像を取得して保存（バックグラウンドで実行）"""
+        def load(task):
+            task.report(-1, "元画像を読み込み中...")
+            # 元画像は1回だけ取得し、以後の計算はすべてこのデータからロックの外で行う
+            data = self.session.snapshot()
+            if data is None:
+                raise SirilError("画像データの取得に失敗しました。")
+            return data
+        
+        self.run_task(load, self.on_original_image_loaded, self.on_original_image_failed)
+    
+    def on_original_image_loaded(self, data):
+        """元画像の読み込みが完了したとき"""
+        self.set_original(data)
+        self.siril.log("元画像を保存しました")
+        self.blur_engine.native_dtype = data.dtype
+        self.set_controls_enabled(True)
+        if self.recorder is not None:
+            self.record_session_header()
+        
+        # 起動時間を報告
+        interactive_time = time.perf_counter() - SCRIPT_START_TIME
+        paint_time = f"{self.first_paint_time:.2f}秒" if self.first_paint_time is not None else "-"
+        self.status_label.setText(f"準備完了 (操作可能まで {interactive_time:.2f}秒)")
+        self.siril.log(f"起動時間: ウィンドウ表示 {paint_time}, 操作可能 {interactive_time:.2f}秒")
+        
+        # ブラーバックエンドを選択（初回のみ画像のサンプルで計測し、結果はキャッシュする）
+        self.start_blur_calibration()
+    
+    def set_original(self, data):
+        """元画像を設定する（書き込み禁止にして、プレビュー・リセット・確定でコピーせずに使う）"""
+        self.buffers = SourceBuffers(data) if self.buffers is None else self.buffers.adopt(data)
+        self.original_image_data = self.buffers.original
+    
+    def release_buffer(self, data):
+        """結果のキャッシュが保持しなくなった配列を出力バッファとして再利用する"""
+        buffers = self.buffers
+        if buffers is not None:
+            buffers.release(data)
+    
+    def pooled_buffer_bytes(self):
+        """再利用のために保持している出力バッファのバイト数（結果のキャッシュの上限に含める）"""
+        buffers = self.buffers
+        return buffers.pooled_bytes if buffers is not None else 0
+    
+    def on_original_image_failed(self, message):
+        """元画像の読み込みに失敗したとき"""
+        self.siril.error_messagebox(f"画像の読み込みエラー: {message}")
+        QApplication.exit(1)
+    
+    def start_blur_calibration(self):
+        """ブラーバックエンドの計測をバックグラウンドで行う"""
+        def calibrate(task):
+            start = time.perf_counter()
+            measured = self.blur_engine.calibrate(self.original_image_data)
+            return measured, time.perf_counter() - start
+        
+        def done(result):
+            measured, elapsed = result
+            if measured:
+                self.siril.log(f"ブラーバックエンドを計測しました ({elapsed:.2f}秒)")
+            self.siril.log(f"ブラーバックエンド: {self.blur_engine.describe()}")
+        
+        def failed(message):
+            # 計測に失敗しても従来の gaussian_filter で処理できる
+            self.siril.log(f"ブラーバックエンドの計測エラー: {message}")
+        
+        self.run_task(calibrate, done, failed, show_progress=False)
+    
+    def set_controls_enabled(self, enabled):
+        """操作部品の有効・無効を切り替える"""
+        for widget in (self.sigma_slider, self.sigma_entry, self.multi_slider, self.multi_entry,
+                       self.multiscale_checkbox, self.threshold_slider, self.threshold_entry,
+                       self.protect_checkbox, self.protect_entry, self.backend_combo,
+                       self.clip_budget_entry, self.noise_budget_entry, self.autotune_button,
+                       self.stats_button, self.history_button, self.preset_combo, self.preset_save_button,
+                       self.preset_delete_button, self.history_list,
+                       self.grid_button, self.reset_button, self.apply_button):
+            widget.setEnabled(enabled)
+        if enabled:
+            self.update_multiscale_widgets()
     
     def create_gui(self):
         """GUIを作成"""
@@ -142,10 +2855,118 @@ class UnsharpMaskGUI(QMainWindow):
         
         main_layout.addLayout(multi_layout)
         
+        # マルチスケール（複数の sigma:multi を1回で適用する。有効な間はSigma/Multiは使わない）
+        layers_layout = QHBoxLayout()
+        self.multiscale_checkbox = QCheckBox("マルチスケール:")
+        self.multiscale_checkbox.toggled.connect(self.on_multiscale_changed)
+        layers_layout.addWidget(self.multiscale_checkbox)
+        
+        self.layers_entry = QLineEdit()
+        self.layers_entry.setText("1.0:0.8, 3.0:0.4")
+        self.layers_entry.setToolTip("sigma:multi をカンマ区切りで指定します")
+        self.layers_entry.setEnabled(False)
+        self.layers_entry.textChanged.connect(self.on_layers_entry_changed)
+        layers_layout.addWidget(self.layers_entry)
+        
+        main_layout.addLayout(layers_layout)
+        
+        # Thresholdパラメータ（元画像とブラー画像の差がこの値以下の画素は強調しない）
+        threshold_layout = QHBoxLayout()
+        threshold_label = QLabel("Threshold:")
+        threshold_label.setMinimumWidth(50)
+        threshold_layout.addWidget(threshold_label)
+        
+        self.threshold_slider = QSlider(Qt.Orientation.Horizontal)
+        self.threshold_slider.setMinimum(0)  # 0.0 * 1000
+        self.threshold_slider.setMaximum(200)  # 0.2 * 1000
+        self.threshold_slider.setValue(0)
+        self.threshold_slider.valueChanged.connect(self.on_threshold_slider_changed)
+        threshold_layout.addWidget(self.threshold_slider)
+        
+        self.threshold_entry = QLineEdit()
+        self.threshold_entry.setText("0.000")
+        self.threshold_entry.setMaximumWidth(80)
+        self.threshold_entry.setMinimumWidth(80)
+        self.threshold_entry.textChanged.connect(self.on_threshold_entry_changed)
+        threshold_layout.addWidget(self.threshold_entry)
+        
+        main_layout.addLayout(threshold_layout)
+        
+        # 星・ハイライトの保護
+        protect_layout = QHBoxLayout()
+        self.protect_checkbox = QCheckBox("星・ハイライトを保護 (明るさ以上):")
+        self.protect_checkbox.toggled.connect(self.on_protect_changed)
+        protect_layout.addWidget(self.protect_checkbox)
+        protect_layout.addStretch()
+        
+        self.protect_entry = QLineEdit()
+        self.protect_entry.setText("0.90")
+        self.protect_entry.setMaximumWidth(80)
+        self.protect_entry.setMinimumWidth(80)
+        self.protect_entry.textChanged.connect(self.on_protect_changed)
+        protect_layout.addWidget(self.protect_entry)
+        
+        main_layout.addLayout(protect_layout)
+        
+        # ブラーバックエンドの選択
+        backend_layout = QHBoxLayout()
+        backend_label = QLabel("Blur:")
+        backend_label.setMinimumWidth(50)
+        backend_layout.addWidget(backend_label)
+        
+        self.backend_combo = QComboBox()
+        self.backend_combo.addItem("自動", None)
+        for name in available_blur_backends():
+            self.backend_combo.addItem(BLUR_BACKENDS[name].label, name)
+        self.backend_combo.currentIndexChanged.connect(self.on_backend_changed)
+        backend_layout.addWidget(self.backend_combo)
+        
+        main_layout.addLayout(backend_layout)
+        
+        # 自動調整（クリップとノイズの上限）
+        autotune_layout = QHBoxLayout()
+        autotune_label = QLabel("自動:")
+        autotune_label.setMinimumWidth(50)
+        autotune_layout.addWidget(autotune_label)
+        autotune_layout.addWidget(QLabel("クリップ ≤"))
+        self.clip_budget_entry = QLineEdit(f"{AUTOTUNE_CLIP_BUDGET * 100:g}")
+        self.clip_budget_entry.setMaximumWidth(60)
+        self.clip_budget_entry.setToolTip("範囲外になってクリップされる画素の割合の上限 (%)")
+        autotune_layout.addWidget(self.clip_budget_entry)
+        autotune_layout.addWidget(QLabel("%  ノイズ ≤ ×"))
+        self.noise_budget_entry = QLineEdit(f"{AUTOTUNE_NOISE_BUDGET:.2f}")
+        self.noise_budget_entry.setMaximumWidth(60)
+        self.noise_budget_entry.setToolTip("背景ノイズの増幅率の上限")
+        autotune_layout.addWidget(self.noise_budget_entry)
+        autotune_layout.addStretch()
+        
+        self.autotune_button = QPushButton("自動調整")
+        self.autotune_button.setToolTip("上限を守りながら最も強くシャープにするsigmaとmultiを探して設定します")
+        self.autotune_button.clicked.connect(self.start_autotune)
+        autotune_layout.addWidget(self.autotune_button)
+        
+        main_layout.addLayout(autotune_layout)
+        
         # ボタンレイアウト
         button_layout = QHBoxLayout()
+        
+        self.stats_button = QPushButton("統計")
+        self.stats_button.setCheckable(True)
+        self.stats_button.setToolTip("プレビューごとにクリップされた画素数・ヒストグラム・エッジとノイズの増幅率を表示します")
+        self.stats_button.toggled.connect(self.on_stats_toggled)
+        button_layout.addWidget(self.stats_button)
+        
+        self.history_button = QPushButton("履歴")
+        self.history_button.setCheckable(True)
+        self.history_button.setToolTip("最近のパラメータとプリセットを表示します（計算済みの結果はすぐに表示されます）")
+        self.history_button.toggled.connect(self.on_history_toggled)
+        button_layout.addWidget(self.history_button)
         button_layout.addStretch()
         
+        self.grid_button = QPushButton("比較")
+        self.grid_button.clicked.connect(self.open_parameter_grid)
+        button_layout.addWidget(self.grid_button)
+        
         self.reset_button = QPushButton("リセット")
         self.reset_button.clicked.connect(self.reset_image)
         button_layout.addWidget(self.reset_button)
@@ -155,8 +2976,239 @@ class UnsharpMaskGUI(QMainWindow):
         button_layout.addWidget(self.apply_button)
         
         main_layout.addLayout(button_layout)
+        
+        # 統計パネル（「統計」ボタンで表示）
+        self.stats_panel = QWidget()
+        stats_layout = QVBoxLayout()
+        stats_layout.setContentsMargins(0, 0, 0, 0)
+        self.stats_panel.setLayout(stats_layout)
+        self.stats_label = QLabel("-")
+        self.stats_label.setWordWrap(True)
+        stats_layout.addWidget(self.stats_label)
+        self.histogram_label = QLabel()
+        self.histogram_label.setToolTip("灰色: 処理前, 橙色: 処理後（縦軸は対数）")
+        stats_layout.addWidget(self.histogram_label)
+        self.stats_panel.hide()
+        main_layout.addWidget(self.stats_panel)
+        
+        # 履歴パネル（「履歴」ボタンで表示）
+        self.history_panel = QWidget()
+        history_layout = QVBoxLayout()
+        history_layout.setContentsMargins(0, 0, 0, 0)
+        self.history_panel.setLayout(history_layout)
+        
+        preset_layout = QHBoxLayout()
+        preset_layout.addWidget(QLabel("プリセット:"))
+        self.preset_combo = QComboBox()
+        self.preset_combo.activated.connect(self.on_preset_selected)
+        preset_layout.addWidget(self.preset_combo, 1)
+        self.preset_save_button = QPushButton("保存")
+        self.preset_save_button.clicked.connect(self.save_preset)
+        preset_layout.addWidget(self.preset_save_button)
+        self.preset_delete_button = QPushButton("削除")
+        self.preset_delete_button.clicked.connect(self.delete_preset)
+        preset_layout.addWidget(self.preset_delete_button)
+        history_layout.addLayout(preset_layout)
+        
+        self.history_list = QListWidget()
+        self.history_list.setMaximumHeight(120)
+        self.history_list.setToolTip("クリックするとそのパラメータに戻します（● は計算済み）")
+        self.history_list.itemClicked.connect(self.on_history_item_clicked)
+        history_layout.addWidget(self.history_list)
+        self.history_panel.hide()
+        main_layout.addWidget(self.history_panel)
+        self.refresh_presets()
+        
+        # 状態表示と進捗バー
+        status_layout = QHBoxLayout()
+        self.status_label = QLabel("Sirilに接続中...")
+        status_layout.addWidget(self.status_label)
+        status_layout.addStretch()
+        
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(120)
+        self.progress_bar.setTextVisible(False)
+        self.progress_bar.hide()
+        status_layout.addWidget(self.progress_bar)
+        
+        self.cancel_button = QPushButton("中止")
+        self.cancel_button.clicked.connect(self.cancel_apply)
+        self.cancel_button.hide()
+        status_layout.addWidget(self.cancel_button)
+        
+        self.record_checkbox = QCheckBox("記録")
+        self.record_checkbox.setToolTip("操作と処理時間をファイルに記録します（遅延の再現用）")
+        self.record_checkbox.setChecked(self.recorder is not None)
+        self.record_checkbox.toggled.connect(self.on_record_toggled)
+        status_layout.addWidget(self.record_checkbox)
+        
+        main_layout.addLayout(status_layout)
         main_layout.addStretch()
     
+    def on_stats_toggled(self, checked):
+        """統計パネルの表示・非表示"""
+        self.stats_panel.setVisible(checked)
+        self.adjustSize()
+        if checked:
+            # 表示中のプレビューの統計を計算する
+            self.schedule_preview_update()
+    
+    def show_stats(self, stats):
+        """統計パネルの表示を更新する"""
+        self.stats_label.setText(stats.describe())
+        before, after = stats.histograms()
+        self.histogram_label.setPixmap(QPixmap.fromImage(histogram_qimage(before, after)))
+    
+    def on_history_toggled(self, checked):
+        """履歴パネルの表示・非表示"""
+        self.history_panel.setVisible(checked)
+        self.adjustSize()
+    
+    def current_params(self):
+        """現在のパラメータ一式を返す。値が範囲外の場合は ValueError を送出する"""
+        threshold, protect_level = self.current_mask_options()
+        return make_params(self.current_layers(), threshold, protect_level)
+    
+    def apply_params(self, params):
+        """パラメータ一式を入力部品に設定する（プレビューも更新される）"""
+        layers = params["layers"]
+        if len(layers) == 1:
+            self.multiscale_checkbox.setChecked(False)
+            self.set_parameters(*layers[0])
+        else:
+            self.layers_entry.setText(", ".join(f"{sigma:g}:{multi:g}" for sigma, multi in layers))
+            self.multiscale_checkbox.setChecked(True)
+        self.threshold_entry.setText(f"{params.get('threshold', 0.0):.3f}")
+        protect = params.get("protect")
+        if protect is not None:
+            self.protect_entry.setText(f"{protect:.2f}")
+        self.protect_checkbox.setChecked(protect is not None)
+    
+    def result_cache_key(self, params):
+        """結果のキャッシュのキー（強制指定したバックエンドによって結果がわずかに変わるため含める）"""
+        return f"{params_key(params)}|{self.blur_engine.forced_backend}"
+    
+    def add_history(self, params):
+        """パラメータを履歴の先頭に追加する"""
+        key = params_key(params)
+        self.history = [params] + [p for p in self.history if params_key(p) != key]
+        del self.history[HISTORY_SIZE:]
+        self.refresh_history()
+    
+    def refresh_history(self):
+        """履歴の一覧を更新する"""
+        self.history_list.clear()
+        for params in self.history:
+            cached = self.result_cache_key(params) in self.result_cache
+            item = QListWidgetItem(("● " if cached else "　 ") + describe_params(params))
+            item.setData(Qt.ItemDataRole.UserRole, params)
+            self.history_list.addItem(item)
+    
+    def on_history_item_clicked(self, item):
+        """履歴の項目がクリックされたとき"""
+        self.apply_params(item.data(Qt.ItemDataRole.UserRole))
+    
+    def refresh_presets(self):
+        """プリセットの一覧を更新する"""
+        self.preset_combo.clear()
+        for name, params in sorted(load_presets().items()):
+            self.preset_combo.addItem(name, params)
+    
+    def on_preset_selected(self, index):
+        """プリセットが選択されたとき"""
+        params = self.preset_combo.itemData(index)
+        if params is not None:
+            self.apply_params(params)
+    
+    def save_preset(self):
+        """現在のパラメータをプリセットとして保存する"""
+        try:
+            params = self.current_params()
+        except ValueError as e:
+            self.siril.error_messagebox(f"値の解析エラー: {e}")
+            return
+        name, ok = QInputDialog.getText(self, "プリセットの保存", "名前:", text=self.preset_combo.currentText())
+        name = name.strip()
+        if not ok or not name:
+            return
+        presets = load_presets()
+        presets[name] = params
+        save_presets(presets)
+        self.refresh_presets()
+        self.preset_combo.setCurrentIndex(self.preset_combo.findText(name))
+        self.siril.log(f"プリセットを保存しました: {name} ({describe_params(params)})")
+    
+    def delete_preset(self):
+        """選択中のプリセットを削除する"""
+        name = self.preset_combo.currentText()
+        presets = load_presets()
+        if name not in presets:
+            return
+        del presets[name]
+        save_presets(presets)
+        self.refresh_presets()
+        self.siril.log(f"プリセットを削除しました: {name}")
+    
+    def connect_recorder(self):
+        """操作部品の入力を記録に接続する"""
+        for name, signal_name in self.RECORDED_INPUTS:
+            widget = getattr(self, name)
+            getattr(widget, signal_name).connect(
+                lambda value=None, name=name: self.record("input", widget=name, value=self.input_value(name, value)))
+    
+    def input_value(self, name, value):
+        """記録する入力値（コンボボックスは項目の番号ではなく名前を記録する）"""
+        if name == "backend_combo":
+            return self.backend_combo.itemData(value)
+        return value
+    
+    def record(self, event_type, **fields):
+        """記録が有効な場合にイベントを記録する"""
+        if self.recorder is not None:
+            self.recorder.record(event_type, **fields)
+    
+    def on_record_toggled(self, checked):
+        """記録の開始・終了"""
+        if checked and self.recorder is None:
+            path = default_session_log_path()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.recorder = SessionRecorder(path)
+            except OSError as e:
+                self.siril.error_messagebox(f"記録ファイルを作成できません: {e}")
+                self.record_checkbox.setChecked(False)
+                return
+            self.record_session_header()
+            self.siril.log(f"操作の記録を開始しました: {path}")
+        elif not checked and self.recorder is not None:
+            self.recorder.close()
+            if self.recorder.path:
+                self.siril.log(f"操作の記録を終了しました: {self.recorder.path}")
+            self.recorder = None
+    
+    def record_session_header(self):
+        """記録の先頭に画像と環境の情報を書き込む"""
+        image = self.original_image_data
+        self.record("session", version=SESSION_LOG_VERSION,
+                    shape=list(image.shape) if image is not None else None,
+                    dtype=str(image.dtype) if image is not None else None,
+                    backend=self.blur_engine.describe(), platform=platform.platform(),
+                    cpu_count=os.cpu_count(), numpy=np.__version__)
+    
+    def replay_input(self, name, value):
+        """記録した入力を操作部品に与える（再生用）"""
+        widget = getattr(self, name)
+        if isinstance(widget, QSlider):
+            widget.setValue(int(value))
+        elif isinstance(widget, QLineEdit):
+            widget.setText(str(value))
+        elif isinstance(widget, QCheckBox):
+            widget.setChecked(bool(value))
+        elif isinstance(widget, QComboBox):
+            widget.setCurrentIndex(max(widget.findData(value), 0))
+        elif isinstance(widget, QPushButton):
+            widget.click()
+    
     def on_sigma_slider_changed(self, value):
         """Sigmaスライドバーの値が変更されたとき"""
         val = value / 10.0
@@ -203,12 +3255,153 @@ class UnsharpMaskGUI(QMainWindow):
             # 無効な値は無視
             pass
     
+    def on_multiscale_changed(self, checked):
+        """マルチスケールの有効・無効が切り替えられたとき"""
+        self.update_multiscale_widgets()
+        self.schedule_preview_update()
+    
+    def update_multiscale_widgets(self):
+        """マルチスケールの状態に合わせて入力部品の有効・無効を切り替える"""
+        multiscale = self.multiscale_checkbox.isChecked()
+        self.layers_entry.setEnabled(multiscale)
+        for widget in (self.sigma_slider, self.sigma_entry, self.multi_slider, self.multi_entry):
+            widget.setEnabled(not multiscale)
+    
+    def on_layers_entry_changed(self, text):
+        """レイヤー入力枠の値が変更されたとき"""
+        try:
+            parse_layers(text)
+            self.schedule_preview_update()
+        except ValueError:
+            # 無効な値は無視
+            pass
+    
+    def current_layers(self):
+        """適用する [(sigma, multi), ...] を返す。値が範囲外の場合は ValueError を送出する"""
+        if self.multiscale_checkbox.isChecked():
+            return parse_layers(self.layers_entry.text())
+        sigma = float(self.sigma_entry.text())
+        multi = float(self.multi_entry.text())
+        if not (0.1 <= sigma <= 10.0):
+            raise ValueError(f"Sigmaの値が範囲外です (0.1-10.0): {sigma}")
+        if not (0.0 <= multi <= 5.0):
+            raise ValueError(f"Multiの値が範囲外です (0.0-5.0): {multi}")
+        return [(sigma, multi)]
+    
+    def on_threshold_slider_changed(self, value):
+        """Thresholdスライドバーの値が変更されたとき"""
+        val = value / 1000.0
+        self.threshold_entry.blockSignals(True)
+        self.threshold_entry.setText(f"{val:.3f}")
+        self.threshold_entry.blockSignals(False)
+        self.schedule_preview_update()
+    
+    def on_threshold_entry_changed(self, text):
+        """Threshold入力枠の値が変更されたとき"""
+        try:
+            val = float(text)
+            if 0.0 <= val <= 0.2:
+                self.threshold_slider.blockSignals(True)
+                self.threshold_slider.setValue(int(round(val * 1000)))
+                self.threshold_slider.blockSignals(False)
+                self.schedule_preview_update()
+        except ValueError:
+            # 無効な値は無視
+            pass
+    
+    def on_protect_changed(self, *args):
+        """保護の設定が変更されたとき"""
+        self.schedule_preview_update()
+    
+    def current_mask_options(self):
+        """(threshold, 保護する明るさ) を返す。保護しない場合、明るさは None
+        
+        値が範囲外の場合は ValueError を送出する。
+        """
+        threshold = float(self.threshold_entry.text())
+        if not (0.0 <= threshold <= 0.2):
+            raise ValueError(f"Thresholdの値が範囲外です (0.0-0.2): {threshold}")
+        if not self.protect_checkbox.isChecked():
+            return threshold, None
+        level = float(self.protect_entry.text())
+        if not (0.0 < level <= 1.0):
+            raise ValueError(f"保護する明るさの値が範囲外です (0.0-1.0): {level}")
+        return threshold, level
+    
+    def on_backend_changed(self, index):
+        """ブラーバックエンドの選択が変更されたとき"""
+        self.blur_engine.forced_backend = self.backend_combo.itemData(index)
+        self.siril.log(f"ブラーバックエンド: {self.blur_engine.describe()}")
+        self.schedule_preview_update()
+    
+    def set_parameters(self, sigma, multi):
+        """sigmaとmultiを入力枠に設定する（スライダーとプレビューも更新される）"""
+        self.sigma_entry.setText(f"{sigma:.2f}")
+        self.multi_entry.setText(f"{multi:.2f}")
+    
+    def start_autotune(self):
+        """sigmaとmultiの自動調整をバックグラウンドで行う"""
+        try:
+            clip_budget = float(self.clip_budget_entry.text()) / 100
+            noise_budget = float(self.noise_budget_entry.text())
+            threshold, protect_level = self.current_mask_options()
+        except ValueError as e:
+            self.siril.error_messagebox(f"自動調整の設定が不正です: {e}")
+            return
+        original = self.original_image_data
+        
+        def search(task):
+            weight = None
+            if protect_level is not None:
+                weight = self.mask_cache.get(original, protect_level)
+            
+            def progress(done, total):
+                task.check_cancelled()
+                task.report(done / total, f"自動調整中 ({done}/{total})")
+            
+            return autotune_parameters(original, self.blur_engine.blur_local, clip_budget, noise_budget,
+                                       threshold=threshold, weight=weight, progress=progress)
+        
+        def done(result):
+            self.set_controls_enabled(True)
+            # 丸めで上限を超えないよう、multiは切り捨てる
+            multi = np.floor(result["multi"] * 100) / 100
+            self.multiscale_checkbox.setChecked(False)
+            self.set_parameters(result["sigma"], multi)
+            message = (f"自動調整: sigma={result['sigma']:.2f}, multi={multi:.2f} "
+                       f"(クリップ {result['clipped'] * 100:.3f}%, エッジ ×{result['edge']:.2f}, "
+                       f"ノイズ ×{result['noise']:.2f}, 評価 {result['evaluations']} 回)")
+            self.status_label.setText(message.split(" (")[0])
+            self.siril.log(message)
+        
+        def failed(message):
+            self.set_controls_enabled(True)
+            self.siril.error_messagebox(f"自動調整エラー: {message}")
+        
+        self.set_controls_enabled(False)
+        self.run_task(search, done, failed, lambda: self.set_controls_enabled(True))
+    
+    def open_parameter_grid(self):
+        """パラメータ比較ダイアログを開く"""
+        dialog = ParameterGridDialog(self)
+        dialog.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose, True)
+        dialog.show()
+        dialog.render()
+    
     def schedule_preview_update(self):
         """プレビュー更新をスケジュール（デバウンス）"""
         # 処理中はスケジュールしない
         if self.is_updating:
+            self.record("schedule", decision="skipped_busy")
+            return
+        if self.original_image_data is None:
+            self.record("schedule", decision="skipped_not_loaded")
+            return
+        if self.apply_task is not None:
+            self.record("schedule", decision="skipped_applying")
             return
         # タイマーをリセット（00ms後に更新、デバウンス時間を少し長くして競合を回避）
+        self.record("schedule", decision="restarted" if self.preview_update_timer.isActive() else "scheduled")
         self.preview_update_timer.stop()
         self.preview_update_timer.start(200)
     
@@ -218,56 +3411,75 @@ class UnsharpMaskGUI(QMainWindow):
             return
         
         try:
-            sigma = float(self.sigma_entry.text())
-            multi = float(self.multi_entry.text())
-            
             # 範囲チェック
-            if not (0.1 <= sigma <= 10.0) or not (0.0 <= multi <= 5.0):
+            try:
+                layers = self.current_layers()
+            except ValueError:
                 return
+            threshold, protect_level = self.current_mask_options()
+            params = make_params(layers, threshold, protect_level)
+            cache_key = self.result_cache_key(params)
             
             self.is_updating = True
             
-            # 画像ロック内で全ての処理を行うことで競合を回避
+            # 計算はすべてロックの外で行い、ロックは結果の受け渡しの間だけ保持する
             try:
-                with self.siril.image_lock():
-                    # 元画像のデータをFloat32に変換して取得
-                    original = self.original_image_data.astype(np.float32)
-                    
-                    # ガウシアンブラーを適用
-                    # カラー画像(3D配列)の場合は、各チャンネルごとに処理されるようにaxisを指定するか、
-                    # gaussian_filterが各軸に対して適用されることを利用する。
-                    # width, height, channelsの順か、channels, height, widthの順かを確認する必要があるが、
-                    # Sirilのデータは通常 (channels, height, width) または (height, width) である。
-                    # gaussian_filterは全軸に対してデフォルトで適用されるため、チャンネル軸(通常0)に対してはsigma=0とする必要がある。
-                    
-                    if original.ndim == 3:
-                        # (channels, height, width) を想定
-                        # チャンネル方向にはブラーをかけない
-                        blurred = gaussian_filter(original, sigma=(0, sigma, sigma))
-                    else:
-                        # モノクロ (height, width)
-                        blurred = gaussian_filter(original, sigma=sigma)
-                    
-                    # アンシャープマスク計算: out = in * (1 + amount) + filtered * (-amount)
-                    # amount = multi
-                    unsharp = original * (1 + multi) - blurred * multi
-                    
-                    # クリップ処理 (元のデータ型に合わせて範囲制限)
-                    if self.original_image_data.dtype == np.uint16:
-                        unsharp = np.clip(unsharp, 0, 65535).astype(np.uint16)
-                    else:
-                        unsharp = np.clip(unsharp, 0.0, 1.0).astype(np.float32)
-                    
-                    # 結果をSirilに設定
-                    fit = self.siril.get_image()
-                    fit.data[:] = unsharp
-                    self.siril.set_image_pixeldata(fit.data)
-                    
+                # 計算済みのパラメータは保持している結果を送るだけにする
+                cached = self.result_cache.get(cache_key)
+                if cached is not None and (cached[1] is not None or not self.stats_button.isChecked()):
+                    start = time.perf_counter()
+                    self.session.push(cached[0], "preview", delays=SESSION_PREVIEW_RETRY_DELAYS)
+                    self.record("preview", status="ok", layers=layers, compute=0.0, cached=True,
+                                transport=time.perf_counter() - start)
+                    if self.stats_button.isChecked():
+                        self.show_stats(cached[1])
+                    self.add_history(params)
+                    self.is_updating = False
+                    return
+                
+                # 元画像は元の型のまま使い、Float32への変換は短冊ごとに行う
+                buffers = self.buffers
+                original = buffers.original
+                weight = None
+                if protect_level is not None:
+                    # 保護マスクは元画像ごとに1回だけ計算する
+                    weight = self.mask_cache.get(self.original_image_data, protect_level)
+                # 統計パネルの表示中は、計算と同時に統計を集計する
+                stats = SharpenStats(original.shape, original.dtype) if self.stats_button.isChecked() else None
+                backend = self.blur_engine.backend_for(max(sigma for sigma, _ in layers))
+                strip_rows = None if backend.tileable else original.shape[-2]
+                
+                # ガウシアンブラーを適用
+                # カラー画像(3D配列)の場合は、各チャンネルごとに処理されるようにaxisを指定するか、
+                # gaussian_filterが各軸に対して適用されることを利用する。
+                # width, height, channelsの順か、channels, height, widthの順かを確認する必要があるが、
+                # Sirilのデータは通常 (channels, height, width) または (height, width) である。
+                # gaussian_filterは全軸に対してデフォルトで適用されるため、チャンネル軸(通常0)に対してはsigma=0とする必要がある。
+                
+                # アンシャープマスク計算: out = in * (1 + amount) + filtered * (-amount)
+                # amount = multi（thresholdと保護マスクを指定した場合は該当画素を強調しない）
+                # マルチスケールでは各sigmaのブラーを1回のスケールスペース計算で求め、まとめて累積する
+                # クリップ処理 (元のデータ型に合わせて範囲制限) は短冊ごとの出力時に行う
+                start = time.perf_counter()
+                unsharp = unsharp_streamed(original, layers, self.blur_engine.blur, buffers.acquire(),
+                                           strip_rows, None, threshold, weight, stats)
+                computed = time.perf_counter()
+                
+                # 結果をSirilに設定
+                self.session.push(unsharp, "preview", delays=SESSION_PREVIEW_RETRY_DELAYS)
+                self.record("preview", status="ok", layers=layers, compute=computed - start,
+                            transport=time.perf_counter() - computed)
+                if stats is not None:
+                    self.show_stats(stats)
+                self.result_cache.put(cache_key, unsharp, stats)
+                self.add_history(params)
+            
             except Exception as e:
+                self.record("preview", status="error", error=str(e))
                 self.siril.log(f"プレビュー更新計算エラー: {e}")
-                
-            self.is_updating = False
             
+            self.is_updating = False
+        
         except (ValueError, SirilError, Exception) as e:
             self.siril.log(f"プレビュー更新エラー: {e}")
             self.is_updating = False
@@ -275,10 +3487,9 @@ class UnsharpMaskGUI(QMainWindow):
     def reset_image(self):
         """元画像に戻す"""
         try:
-            with self.siril.image_lock():
-                fit = self.siril.get_image()
-                fit.data[:] = self.original_image_data.copy()
-                self.siril.set_image_pixeldata(fit.data)
+            start = time.perf_counter()
+            self.session.push(self.original_image_data, "reset")
+            self.record("reset", transport=time.perf_counter() - start)
             
             # パラメータをリセット
             self.sigma_slider.blockSignals(True)
@@ -295,6 +3506,22 @@ class UnsharpMaskGUI(QMainWindow):
             self.multi_entry.setText("1.0")
             self.multi_entry.blockSignals(False)
             
+            self.threshold_slider.blockSignals(True)
+            self.threshold_slider.setValue(0)
+            self.threshold_slider.blockSignals(False)
+            self.threshold_entry.blockSignals(True)
+            self.threshold_entry.setText("0.000")
+            self.threshold_entry.blockSignals(False)
+            
+            self.protect_checkbox.blockSignals(True)
+            self.protect_checkbox.setChecked(False)
+            self.protect_checkbox.blockSignals(False)
+            
+            self.multiscale_checkbox.blockSignals(True)
+            self.multiscale_checkbox.setChecked(False)
+            self.multiscale_checkbox.blockSignals(False)
+            self.update_multiscale_widgets()
+            
             self.siril.log("画像をリセットしました")
         except SirilError as e:
             self.siril.error_messagebox(f"リセットエラー: {e}")
@@ -304,69 +3531,624 @@ class UnsharpMaskGUI(QMainWindow):
     def apply_changes(self):
         """変更を確定"""
         try:
-            sigma = float(self.sigma_entry.text())
-            multi = float(self.multi_entry.text())
-            
             # 範囲チェック
-            if not (0.1 <= sigma <= 10.0):
-                self.siril.error_messagebox(f"Sigmaの値が範囲外です (0.1-10.0): {sigma}")
+            try:
+                layers = self.current_layers()
+                threshold, protect_level = self.current_mask_options()
+            except ValueError as e:
+                self.siril.error_messagebox(f"値の解析エラー: {e}")
                 return
-            if not (0.0 <= multi <= 5.0):
-                self.siril.error_messagebox(f"Multiの値が範囲外です (0.0-5.0): {multi}")
+            
+            if self.apply_task is not None:
                 return
             
-            # undo状態を保存（変更を適用する前に）
-            # 注意: undo_save_stateはimage_lock内で実行する必要がある
-            with self.siril.image_lock():
-                self.siril.undo_save_state(f"Unsharp Mask: sigma={sigma:.2f}, multi={multi:.2f}")
-                
-                 # 元画像のデータをFloat32に変換して取得
-                original = self.original_image_data.astype(np.float32)
-                
-                # ガウシアンブラーを適用
-                if original.ndim == 3:
-                    # (channels, height, width)
-                    blurred = gaussian_filter(original, sigma=(0, sigma, sigma))
-                else:
-                    # (height, width)
-                    blurred = gaussian_filter(original, sigma=sigma)
+            buffers = self.buffers
+            original = buffers.original
+            backend = self.blur_engine.backend_for(max(sigma for sigma, _ in layers))
+            params = make_params(layers, threshold, protect_level)
+            cache_key = self.result_cache_key(params)
+            description = describe_params(params)
+            undo_message = f"Unsharp Mask: {description}"
+            if backend.needs_command:
+                # Sirilのコマンドを使うバックエンドは計算中に画像を書き換えるため、
+                # 先にundo状態を保存する（コマンドは途中で中止できない）
+                self.session.save_undo(undo_message)
+            
+            # 計算はタイル単位でバックグラウンドで行い、Sirilの画像には最後まで触れない
+            def compute(task):
+                start = time.perf_counter()
+                # プレビューで計算済みの場合はその結果を使う
+                cached = self.result_cache.get(cache_key)
+                if cached is not None and cached[1] is not None and not backend.needs_command:
+                    return cached[0], cached[1], time.perf_counter() - start
                 
-                # アンシャープマスク計算
-                unsharp = original * (1 + multi) - blurred * multi
+                def progress(done, total):
+                    task.check_cancelled()
+                    elapsed = time.perf_counter() - start
+                    remaining = elapsed * (total - done) / done
+                    task.report(done / total, f"適用中 {done * 100 // total}% (残り約{remaining:.0f}秒)")
                 
-                # クリップ処理
-                if self.original_image_data.dtype == np.uint16:
-                    unsharp = np.clip(unsharp, 0, 65535).astype(np.uint16)
-                else:
-                    unsharp = np.clip(unsharp, 0.0, 1.0).astype(np.float32)
-
-                # 結果を適用（確定）
-                fit = self.siril.get_image()
-                fit.data[:] = unsharp
-                self.siril.set_image_pixeldata(fit.data)
+                weight = None
+                if protect_level is not None:
+                    weight = self.mask_cache.get(original, protect_level)
+                strip_rows = None if backend.tileable else original.shape[-2]
+                stats = SharpenStats(original.shape, original.dtype)
+                unsharp = unsharp_streamed(original, layers, self.blur_engine.blur, buffers.acquire(),
+                                           strip_rows, progress, threshold, weight, stats)
+                return unsharp, stats, time.perf_counter() - start
             
-            # 元画像を更新（確定した画像を新しい元画像とする）
-            with self.siril.image_lock():
-                fit = self.siril.get_image()
-                self.original_image_data = fit.data.copy()
+            def done(result):
+                unsharp, stats, compute_time = result
+                self.finish_apply()
+                try:
+                    start = time.perf_counter()
+                    # ロックは最後の画素データの受け渡しの間だけ保持する
+                    self.session.push(unsharp, "apply", None if backend.needs_command else undo_message)
+                    
+                    # 元画像を更新（送った結果をそのまま新しい元画像とし、Sirilから読み直さない）
+                    self.set_original(unsharp)
+                    # 元画像が変わったので、保持している結果は使えない
+                    self.result_cache.clear()
+                    self.refresh_history()
+                    self.record("apply", status="ok", layers=layers, compute=compute_time,
+                                transport=time.perf_counter() - start)
+                    
+                    self.siril.log(f"Unsharp Maskを適用しました ({description})")
+                    self.siril.log(stats.describe().replace("\n", ", "))
+                    self.status_label.setText("変更を確定しました")
+                    self.siril.info_messagebox("変更を確定しました")
+                except Exception as e:
+                    restore()
+                    self.record("apply", status="error", error=str(e))
+                    self.siril.error_messagebox(f"確定エラー: {e}")
             
-            self.siril.log(f"Unsharp Maskを適用しました (sigma={sigma:.2f}, multi={multi:.2f})")
-            self.siril.info_messagebox("変更を確定しました")
+            def failed(message):
+                self.finish_apply()
+                restore()
+                self.record("apply", status="error", error=message)
+                self.siril.error_messagebox(f"確定エラー: {message}")
+            
+            def restore():
+                # Sirilのコマンドを使うバックエンドは計算中にSirilの画像をブラー画像で上書きしているので、
+                # 元画像に戻す（先に保存したundo状態は元画像なので、画像と食い違わない）
+                if not backend.needs_command:
+                    return
+                try:
+                    self.session.push(original, "restore")
+                    self.siril.log("確定に失敗したため、元画像に戻しました")
+                except SirilError as e:
+                    self.siril.log(f"元画像に戻せませんでした: {e}")
+            
+            def cancelled():
+                # Sirilの画像とundo履歴には何も書き込んでいないので、そのまま終了する
+                self.finish_apply()
+                self.record("apply", status="cancelled")
+                self.siril.log("Unsharp Maskの適用を中止しました")
+                self.status_label.setText("適用を中止しました")
+            
+            self.preview_update_timer.stop()
+            self.set_controls_enabled(False)
+            self.cancel_button.setEnabled(not backend.needs_command)
+            self.cancel_button.show()
+            self.apply_restore = restore
+            self.apply_task = self.run_task(compute, done, failed, cancelled)
         except ValueError as e:
             self.siril.error_messagebox(f"値の解析エラー: {e}")
         except SirilError as e:
             self.siril.error_messagebox(f"確定エラー: {e}")
         except Exception as e:
             self.siril.error_messagebox(f"確定エラー: {e}")
+    
+    def cancel_apply(self):
+        """確定処理を中止する"""
+        if self.apply_task is not None:
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText("中止しています...")
+            self.apply_task.cancel()
+    
+    def finish_apply(self):
+        """確定処理の終了後に操作部品を元に戻す"""
+        self.apply_task = None
+        self.apply_restore = None
+        self.cancel_button.hide()
+        self.set_controls_enabled(True)
+    
+    def stop_tasks(self):
+        """実行中のバックグラウンド処理をすべて中止し、終わるまで待つ（ウィンドウを閉じるとき用）"""
+        for dialog in self.findChildren(ParameterGridDialog):
+            dialog.cancel_task()
+        tasks = list(self.tasks)
+        for task in tasks:
+            # 閉じた後に結果を受け取る処理が動かないようにする
+            task.blockSignals(True)
+            task.cancel()
+        for task in tasks:
+            task.wait()
+        self.tasks = []
+    
+    def closeEvent(self, event):
+        # スレッドが動いたままQThreadが破棄されるとプロセスごと異常終了するので、先に止める
+        restore = self.apply_restore if self.apply_task is not None else None
+        self.stop_tasks()
+        if restore is not None:
+            # 確定の途中で閉じた場合は、Sirilの画像を元画像に戻す（Sirilのコマンドを使う場合のみ必要）
+            restore()
+        self.result_cache.close()
+        # 画像ロックを保持した時間をログに残す
+        metrics = self.session.describe_metrics()
+        if metrics:
+            try:
+                self.siril.log(f"画像ロック: {metrics}")
+            except SirilError:
+                pass
+        super().closeEvent(event)
+
+
+# ---------------------------------------------------------------------------
+# 記録した操作の再生（ヘッドレス）
+# ---------------------------------------------------------------------------
+
+def process_events_until(app, condition, timeout=600.0):
+    """condition() が真になるまでQtのイベントを処理する"""
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("処理が時間内に終わりませんでした")
+        app.processEvents()
+        time.sleep(0.005)
+
+
+def start_offscreen_gui(image, recorder=None):
+    """LocalSirilInterface を相手に画面なしで UnsharpMaskGUI を起動し、(app, window) を返す
+    
+    元画像の読み込みとバックエンドの計測が終わるまで待ってから返す。
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    window = UnsharpMaskGUI(siril=LocalSirilInterface(image), recorder=recorder)
+    window.start_session()
+    process_events_until(app, lambda: window.original_image_data is not None and not window.tasks)
+    return app, window
+
+
+def replay_session(log_path, image=None, speed=1.0, output_path=None):
+    """記録した操作を LocalSirilInterface に対して同じ時間間隔で再生し、遅延の集計を返す
+    
+    image を省略すると、記録した画像と同じ形・型のテスト画像を使う。
+    """
+    header, events = load_session_log(log_path)
+    inputs = [e for e in events if e["type"] == "input"]
+    if image is None:
+        if not header.get("shape"):
+            raise ValueError("記録に画像の情報がありません。--image で画像を指定してください")
+        image = make_test_image(tuple(header["shape"]), np.dtype(header["dtype"]))
+    
+    recorder = SessionRecorder(output_path)
+    app, window = start_offscreen_gui(image, recorder)
+    
+    if inputs:
+        base = inputs[0]["t"]
+        for event in inputs:
+            delay = int(max(event["t"] - base, 0.0) / speed * 1000)
+            QTimer.singleShot(delay, lambda e=event: window.replay_input(e["widget"], e["value"]))
+        process_events_until(app, lambda: time.perf_counter() - recorder.start
+                             > (inputs[-1]["t"] - base) / speed + 0.1
+                             and not window.preview_update_timer.isActive()
+                             and not window.is_updating and not window.tasks)
+    
+    recorder.close()
+    window.close()
+    return summarize_session(recorder.events)
+
+
+def command_replay(args):
+    """replay サブコマンド"""
+    image = np.load(args.image) if args.image else None
+    summary = replay_session(args.log, image, args.speed, args.output)
+    print(format_summary(summary))
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# 自己テスト（高速化した処理が基準の計算と一致することと、速度の確認）
+# ---------------------------------------------------------------------------
+
+SELFTEST_SHAPES = (
+    ("1x1", (1, 1)),
+    ("3x5", (3, 5)),
+    # sigma=10 の余白 (40画素) より小さい画像
+    ("20x30", (20, 30)),
+    ("96x128", (96, 128)),
+)
+SELFTEST_SIGMAS = (0.1, 1.0, 10.0)
+SELFTEST_MULTIS = (0.0, 0.8, 5.0)
+# 許容する差（16bit換算の値）
+# 同じブラー（scipy）を使う処理は完全に一致すること
+SELFTEST_EXACT = 0
+# GUIのプレビュー・リセット・確定で1回あたりに新しく確保してよい画像サイズの配列の数の上限
+# （Sirilへの送信は常に1枚分）。確定の結果は新しい元画像になるので、確定だけは1つまで確保してよい
+SELFTEST_BUFFER_ALLOCATIONS = {"preview": 0, "cached": 0, "reset": 0, "apply": 1}
+# 別の方法でブラーを計算するバックエンドは、浮動小数点の丸め誤差が multi 倍されたうえで
+# 出力の型に丸められる。ブラーの誤差はデータ範囲の 1e-6 以下なので、丸めの1と合わせて許容する
+SELFTEST_BLUR_ERROR = 1e-6
+# マルチスケールはスケールスペースで計算するため、前の段に重ねてブラーをかけたsigmaは直接
+# かけた場合と少し異なる（scale_space_steps() を参照）。ブラーの差はデータ範囲の 1e-4 以下なので、
+# multiの合計倍したうえで丸めの1と合わせて許容する
+SELFTEST_SCALE_SPACE_ERROR = 1e-4
+# 近い値や小さいsigmaを含むレイヤーの組（小さいsigmaは直接ブラーをかけるので差は丸めの分だけ）
+SELFTEST_LAYER_SETS = (
+    ((0.1, 0.8), (1.0, 0.5), (10.0, 0.3)),
+    ((0.5, 2.0), (0.6, 2.0)),
+    ((0.3, 5.0), (0.4, 5.0)),
+    ((0.8, 5.0), (1.0, 5.0), (1.5, 5.0), (2.0, 5.0), (3.0, 5.0)),
+)
+# 速度: 基準の計算に対して許容する処理時間の倍率（と計測の揺らぎを吸収する余裕）
+SELFTEST_TIMING_SHAPE = (3, 1024, 1024)
+SELFTEST_MAX_SLOWDOWN = 1.5
+SELFTEST_TIMING_SLACK = 0.005
+
+
+def reference_unsharp(original, layers):
+    """v3の基準の計算: gaussian_filter(original, sigma=(0, s, s)) と original*(1+m) - blurred*m、型ごとの範囲制限
+    
+    マルチスケールは各sigmaで直接ブラーをかけて out = in + Σ m*(in - blur) とする。
+    """
+    data = original.astype(np.float32)
+    if len(layers) == 1:
+        sigma, multi = layers[0]
+        blurred = gaussian_filter(data, sigma=spatial_sigma(data, sigma))
+        return clip_to_dtype(data * (1 + multi) - blurred * multi, original.dtype)
+    total = data.copy()
+    for sigma, multi in layers:
+        total += multi * (data - gaussian_filter(data, sigma=spatial_sigma(data, sigma)))
+    return clip_to_dtype(total, original.dtype)
+
+
+def difference_16bit(result, expected):
+    """2つの結果の最大差を16bit換算で返す"""
+    if result.shape != expected.shape or result.dtype != expected.dtype:
+        return float("inf")
+    scale = 65535.0 / dtype_max(expected.dtype)
+    return float(np.max(np.abs(result.astype(np.float64) - expected.astype(np.float64)), initial=0.0)) * scale
+
+
+def selftest_images():
+    """(名前, 画像) を モノクロ/RGB × uint16/float32 × 大きさ の組み合わせで返す"""
+    for dtype in (np.uint16, np.float32):
+        for channels in (1, 3):
+            for size_name, size in SELFTEST_SHAPES:
+                shape = size if channels == 1 else (channels,) + size
+                name = f"{'mono' if channels == 1 else 'rgb'}-{np.dtype(dtype).name}-{size_name}"
+                yield name, make_test_image(shape, dtype, seed=len(name))
+
+
+def selftest_fast_paths():
+    """基準と比べる処理の一覧 [(名前, 関数(original, layers), 許容差(multi) の関数)]"""
+    scipy_blur = BLUR_BACKENDS["scipy"]().blur
+    paths = [
+        ("streamed", lambda original, layers: unsharp_streamed(original, layers, scipy_blur),
+         lambda multi: SELFTEST_EXACT),
+        # 余白より小さい短冊に分けても一致すること
+        ("streamed-7rows", lambda original, layers: unsharp_streamed(original, layers, scipy_blur, None, 7),
+         lambda multi: SELFTEST_EXACT),
+        ("sharpen", lambda original, layers: clip_to_dtype(sharpen(
+            original.astype(np.float32),
+            scipy_blur(original.astype(np.float32), layers[0][0]), layers[0][1]), original.dtype),
+         lambda multi: SELFTEST_EXACT),
+        ("cache", lambda original, layers: unpack_array(pack_array(
+            unsharp_streamed(original, layers, scipy_blur)), original.shape, original.dtype),
+         lambda multi: SELFTEST_EXACT),
+    ]
+    for name in available_blur_backends():
+        backend = BLUR_BACKENDS[name]
+        # 近似のバックエンド（再帰型）とSirilのコマンドを使うバックエンドは対象外
+        if name == "scipy" or not backend.exact or backend.needs_command:
+            continue
+        strip_rows = None if backend.tileable else -1
+        paths.append((f"backend-{name}",
+                      lambda original, layers, blur=backend().blur, rows=strip_rows: unsharp_streamed(
+                          original, layers, blur, None, original.shape[-2] if rows == -1 else rows),
+                      lambda multi: 1 + SELFTEST_BLUR_ERROR * multi * 65535))
+    return paths
+
+
+def selftest_file_paths(directory):
+    """ファイルを経由する処理（一括処理・大きなFITS）を基準と比べる処理の一覧"""
+    scipy_blur = BLUR_BACKENDS["scipy"]().blur
+    
+    def batch(original, layers):
+        path = os.path.join(directory, "frame.npy")
+        np.save(path, original)
+        run_batch([path], directory, layers, blur=scipy_blur, prefetch=1, workers=1)
+        return np.load(batch_output_path(path, directory))
+    
+    def process(original, layers):
+        fits = lazy_fits()
+        path = os.path.join(directory, "frame.fit")
+        fits.PrimaryHDU(original).writeto(path, overwrite=True)
+        # 1行ずつ読み込むよう、読み込み量を最小にする
+        unsharp_fits_file(path, path + ".out.fit", layers, scipy_blur, chunk_bytes=1)
+        return fits.getdata(path + ".out.fit").astype(original.dtype)
+    
+    paths = [("batch", batch, lambda multi: SELFTEST_EXACT)]
+    if importlib.util.find_spec("astropy") is not None:
+        paths.append(("process", process, lambda multi: SELFTEST_EXACT))
+    return paths
+
+
+def selftest_correctness(report, files=True):
+    """すべての処理を基準の計算と比べ、失敗した数を返す"""
+    failures = 0
+    directory = tempfile.mkdtemp(prefix="siril_unsharp_selftest_")
+    try:
+        paths = selftest_fast_paths()
+        file_paths = selftest_file_paths(directory) if files else []
+        for image_name, original in selftest_images():
+            for sigma in SELFTEST_SIGMAS:
+                for multi in SELFTEST_MULTIS:
+                    layers = [(sigma, multi)]
+                    expected = reference_unsharp(original, layers)
+                    # ファイルを経由する処理は時間がかかるので、multiは1つだけ試す
+                    candidates = paths + (file_paths if multi == SELFTEST_MULTIS[1] else [])
+                    for path_name, func, tolerance in candidates:
+                        try:
+                            diff = difference_16bit(func(original, layers), expected)
+                            error = None
+                        except Exception as e:
+                            diff, error = float("inf"), f"{type(e).__name__}: {e}"
+                        if diff > tolerance(multi):
+                            failures += 1
+                            report(f"FAIL {path_name:16s} {image_name:22s} sigma={sigma:<4g} multi={multi:<4g} "
+                                   f"差={diff:.2f} (許容 {tolerance(multi):.2f}){' ' + error if error else ''}")
+            
+            # マルチスケール（スケールスペース）
+            scipy_blur = BLUR_BACKENDS["scipy"]().blur
+            for layers in SELFTEST_LAYER_SETS:
+                diff = difference_16bit(unsharp_streamed(original, layers, scipy_blur),
+                                        reference_unsharp(original, layers))
+                tolerance = SELFTEST_SCALE_SPACE_ERROR * 65535 * sum(multi for _, multi in layers) + 1
+                if diff > tolerance:
+                    failures += 1
+                    report(f"FAIL {'multiscale':16s} {image_name:22s} {describe_layers(layers)} "
+                           f"差={diff:.2f} (許容 {tolerance:.2f})")
+            report(f"ok   {image_name}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return failures
+
+
+def selftest_buffers(report):
+    """GUIのプレビュー・リセット・確定が、画像1枚分の送信だけで余分なコピーをしないことを確認する"""
+    failures = 0
+    for dtype in (np.uint16, np.float32):
+        image = make_test_image((3, 96, 128), dtype)
+        results = benchmark_buffers(image, [(2.0, 0.8)], repeats=2)["gui"]
+        for name, allocations in SELFTEST_BUFFER_ALLOCATIONS.items():
+            stats = results[name]
+            if (stats["received"] != 0 or stats["sent"] != 1 or stats["allocations"] > allocations
+                    or stats["error"] > SELFTEST_EXACT):
+                failures += 1
+                report(f"FAIL {'buffers-' + name:16s} {np.dtype(dtype).name:8s} 受信={stats['received']:g} "
+                       f"送信={stats['sent']:g} 確保={stats['allocations']:g} (許容 {allocations}) "
+                       f"差={stats['error']:g}")
+        report(f"ok   buffers-{np.dtype(dtype).name}")
+    return failures
+
+
+def best_time(func, repeats=3):
+    """repeats 回実行した中で最短の処理時間を返す"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def selftest_timing(report):
+    """高速化した処理が基準の計算より遅くなっていないことを確認し、失敗した数を返す"""
+    failures = 0
+    original = make_test_image(SELFTEST_TIMING_SHAPE, np.uint16)
+    engine = BlurEngine(None, original.dtype)
+    engine.calibrate(original)
+    scipy_blur = BLUR_BACKENDS["scipy"]().blur
+    for sigma in (1.0, 5.0):
+        layers = [(sigma, 0.8)]
+        reference = best_time(lambda: reference_unsharp(original, layers))
+        for path_name, func in (
+                ("streamed", lambda: unsharp_streamed(original, layers, scipy_blur)),
+                ("auto", lambda: unsharp_streamed(original, layers, engine.blur_local)),
+                ("stats", lambda: unsharp_streamed(original, layers, engine.blur_local, stats=SharpenStats(
+                    original.shape, original.dtype)))):
+            elapsed = best_time(func)
+            limit = reference * SELFTEST_MAX_SLOWDOWN + SELFTEST_TIMING_SLACK
+            ok = elapsed <= limit
+            failures += not ok
+            report(f"{'ok  ' if ok else 'FAIL'} 速度 {path_name:10s} sigma={sigma:<4g} {elapsed * 1000:7.1f}ms "
+                   f"(基準 {reference * 1000:.1f}ms, 上限 {limit * 1000:.1f}ms)")
+    return failures
+
+
+def params_from_args(args):
+    """コマンドライン引数（--preset / --layers / --sigma と --multi）から (layers, threshold, protect) を得る"""
+    threshold, protect = args.threshold, getattr(args, "protect", None)
+    if args.preset:
+        presets = load_presets()
+        if args.preset not in presets:
+            raise ValueError(f"プリセットが見つかりません: {args.preset} (保存済み: {', '.join(sorted(presets)) or 'なし'})")
+        preset = presets[args.preset]
+        layers = [tuple(layer) for layer in preset["layers"]]
+        threshold, protect = preset.get("threshold", 0.0), preset.get("protect")
+    elif args.layers:
+        layers = parse_layers(args.layers)
+    else:
+        layers = parse_layers(f"{args.sigma}:{args.multi}")
+    return layers, threshold, protect
+
+
+def add_params_arguments(parser):
+    """パラメータを指定する引数を追加する"""
+    parser.add_argument("--sigma", type=float, default=1.0)
+    parser.add_argument("--multi", type=float, default=1.0)
+    parser.add_argument("--layers", help="マルチスケールのレイヤー (例: 1.0:0.8, 3.0:0.4)")
+    parser.add_argument("--threshold", type=float, default=0.0)
+    parser.add_argument("--preset", help="GUIで保存したプリセットの名前（sigma・multi・threshold・protectを上書きする）")
+
+
+def command_process(args):
+    """process サブコマンド"""
+    def progress(done, total):
+        print(f"\r{done * 100 // total}%", end="", file=sys.stderr, flush=True)
+    
+    try:
+        layers, threshold, protect = params_from_args(args)
+        if protect is not None:
+            print("注意: process では保護マスクは使えないため、protect は無視します", file=sys.stderr)
+        engine = BlurEngine()
+        if args.backend:
+            engine.forced_backend = args.backend
+        else:
+            # 計測には画像中央の行だけを読み込む
+            source = FITSImageFile.open(args.input)
+            top = max(source.height // 2 - CALIBRATION_SAMPLE_SIZE // 2, 0)
+            sample = source.read_rows(top, min(top + CALIBRATION_SAMPLE_SIZE, source.height))
+            engine.native_dtype = sample.dtype
+            engine.calibrate(sample)
+        report = unsharp_fits_file(args.input, args.output, layers, engine.blur_local, threshold,
+                                   args.chunk_mb * 1024 * 1024, progress)
+    except (ValueError, OSError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 1
+    print(file=sys.stderr)
+    print(f"{describe_params(make_params(layers, threshold))} ({engine.describe()})")
+    print(f"{'x'.join(map(str, report['shape']))} {report['dtype']}: {report['chunks']} 回に分けて処理 "
+          f"({report['rows']} 行ずつ), {report['seconds']:.2f} 秒")
+    return 0
+
+
+def command_batch(args):
+    """batch サブコマンド"""
+    paths = expand_frame_paths(args.frames)
+    
+    def progress(done, total):
+        print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+    
+    try:
+        layers, threshold, protect = params_from_args(args)
+        engine = BlurEngine()
+        if args.backend:
+            engine.forced_backend = args.backend
+        elif paths:
+            first, _ = read_frame(paths[0])
+            engine.native_dtype = first.dtype
+            engine.calibrate(first)
+        report = run_batch(paths, args.output_dir, layers, threshold, protect,
+                           engine.blur_local, args.prefetch, args.workers, args.prefix, progress)
+    except (ValueError, OSError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 1
+    print(file=sys.stderr)
+    print(f"{describe_params(make_params(layers, threshold, protect))} ({engine.describe()})")
+    print(format_batch_report(report))
+    return 0
+
+
+def command_benchmark(args):
+    """benchmark サブコマンド"""
+    layers = parse_layers(f"{args.sigma}:{args.multi}")
+    if args.buffers:
+        results = {}
+        for size in args.sizes:
+            print(f"{size}x{size} buffers", file=sys.stderr)
+            shape = (args.channels, size, size) if args.channels > 1 else (size, size)
+            results[size] = benchmark_buffers(make_test_image(shape, np.dtype(args.dtype)), layers, args.repeats)
+        print(format_buffer_benchmark(results))
+        return 0
+    results = benchmark_preview_strategies(args.sizes, args.channels, np.dtype(args.dtype), layers,
+                                           args.repeats, lambda message: print(message, file=sys.stderr))
+    print(format_benchmark(results))
+    return 0
+
+
+def command_selftest(args):
+    """selftest サブコマンド"""
+    report = print
+    failures = selftest_correctness(report, files=not args.quick)
+    failures += selftest_buffers(report)
+    if not args.no_timing:
+        failures += selftest_timing(report)
+    print("すべて成功しました" if failures == 0 else f"{failures} 件失敗しました")
+    return 0 if failures == 0 else 1
+
+
+def build_argument_parser():
+    """コマンドライン引数の定義（引数なしで起動した場合はGUIを表示する）"""
+    parser = argparse.ArgumentParser(description="Unsharp Mask v3 for Siril")
+    commands = parser.add_subparsers(dest="command")
+    
+    replay = commands.add_parser("replay", help="記録した操作を再生して遅延を集計する")
+    replay.add_argument("log", help="記録ファイル (.jsonl)")
+    replay.add_argument("--image", help="使用する画像 (.npy)。省略時は同じ大きさのテスト画像")
+    replay.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率")
+    replay.add_argument("--output", help="再生時の記録の保存先")
+    replay.set_defaults(handler=command_replay)
+    
+    batch = commands.add_parser("batch", help="複数のフレームに同じパラメータで一括適用する")
+    batch.add_argument("frames", nargs="+", help="入力フレーム (.fit/.fits/.fts/.npy、ワイルドカード可)")
+    batch.add_argument("-o", "--output-dir", required=True, help="出力先のディレクトリ")
+    add_params_arguments(batch)
+    batch.add_argument("--protect", type=float, help="星・ハイライトを保護する明るさ (0-1)")
+    batch.add_argument("--backend", choices=sorted(BLUR_BACKENDS), help="ブラーの計算方法（省略時は自動）")
+    batch.add_argument("--prefetch", type=int, default=BATCH_PREFETCH, help="先読みするフレーム数")
+    batch.add_argument("--workers", type=int, help="計算スレッド数")
+    batch.add_argument("--prefix", default=BATCH_PREFIX, help="出力ファイル名の接頭辞")
+    batch.set_defaults(handler=command_batch)
+    
+    process = commands.add_parser("process", help="メモリに収まらない大きなFITS画像を少しずつ読み書きして処理する")
+    process.add_argument("input", help="入力FITSファイル")
+    process.add_argument("output", help="出力FITSファイル")
+    add_params_arguments(process)
+    process.add_argument("--backend", choices=sorted(BLUR_BACKENDS), help="ブラーの計算方法（省略時は自動）")
+    process.add_argument("--chunk-mb", type=int, default=PROCESS_CHUNK_BYTES // (1024 * 1024),
+                         help="1回に読み込む量の目安 (MB)")
+    process.set_defaults(handler=command_process)
+    
+    benchmark = commands.add_parser("benchmark", help="プレビューの転送方法を比較し、画像サイズごとに最速の方法を記録する")
+    benchmark.add_argument("--sizes", type=lambda text: [int(v) for v in text.split(",")],
+                           default=list(BENCHMARK_SIZES), help="画像の一辺の画素数 (例: 512,1024,2048)")
+    benchmark.add_argument("--channels", type=int, default=3, choices=(1, 3))
+    benchmark.add_argument("--dtype", default="uint16", choices=("uint16", "float32"))
+    benchmark.add_argument("--sigma", type=float, default=BENCHMARK_LAYERS[0][0])
+    benchmark.add_argument("--multi", type=float, default=BENCHMARK_LAYERS[0][1])
+    benchmark.add_argument("--repeats", type=int, default=3)
+    benchmark.add_argument("--buffers", action="store_true",
+                           help="プレビュー・リセット・確定で受け渡し・コピーするデータ量を元のv3と比べる")
+    benchmark.set_defaults(handler=command_benchmark)
+    
+    selftest = commands.add_parser("selftest", help="高速化した処理が基準の計算と一致すること・遅くなっていないことを確認する")
+    selftest.add_argument("--no-timing", action="store_true", help="速度の確認を省略する")
+    selftest.add_argument("--quick", action="store_true", help="ファイルを経由する処理の確認を省略する")
+    selftest.set_defaults(handler=command_selftest)
+    return parser
 
 
 def main():
     """メインエントリーポイント"""
+    if len(sys.argv) > 1:
+        args = build_argument_parser().parse_args()
+        if args.command is not None:
+            sys.exit(args.handler(args))
+    
     app = QApplication(sys.argv)
     
     try:
         window = UnsharpMaskGUI()
         window.show()
+        # 最初の描画を済ませてから接続と元画像の読み込みを開始する
+        app.processEvents()
+        window.first_paint_time = time.perf_counter() - SCRIPT_START_TIME
+        QTimer.singleShot(0, window.start_session)
         sys.exit(app.exec())
     except Exception as e:
         print(f"エラー: {e}", file=sys.stderr)